@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from MageTabParser import parse_sdrf
+from Transform import Transform
+
+# modules imported to start the workflow or a worker process, whose import time is checked against a budget
+STARTUP_MODULES = ("workflow_manager", "Extract", "Transform")
+
+
+def write_synthetic_staging(path: str, datasets: int, samples: int = 20, platforms: int = 1,
+                            platform_rows: int = 1000, sample_rows: int = 1000, seed: int = 0) -> None:
+    """
+    This function fills a staging area with synthetic GEO family SOFT files and ArrayExpress SDRF/IDF files, with the
+    same structure as the extracted ones, to measure the pipeline on catalogs larger than the real one
+    :param path: staging area folder (created if needed)
+    :param datasets: number of datasets of each source (GEO and ArrayExpress)
+    :param samples: number of samples of each dataset
+    :param platforms: number of platforms of each GEO dataset
+    :param platform_rows: number of rows of the data table of each GEO platform
+    :param sample_rows: number of rows of the data table of each GEO sample
+    :param seed: seed of the random values, so that the same arguments give the same files
+    """
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+
+    for n in range(1, datasets + 1):
+        gse = "GSE" + str(900000 + n)
+        gpls = ["GPL" + str(90000 + n * platforms + p) for p in range(platforms)]
+        gsms = ["GSM" + str(9000000 + n * samples + s) for s in range(samples)]
+        with gzip.open(path + gse + "_family.soft.gz", "wt", encoding="utf-8", compresslevel=1) as f:
+            f.write("^DATABASE = GeoMiame\n!Database_name = Gene Expression Omnibus (GEO)\n")
+            f.write("^SERIES = " + gse + "\n")
+            f.write("!Series_title = Synthetic series " + str(n) + "\n")
+            f.write("!Series_geo_accession = " + gse + "\n")
+            f.write("!Series_last_update_date = Jan 01 2024\n")
+            f.write("!Series_overall_design = Synthetic design of series " + str(n) + "\n")
+            f.write("!Series_type = Expression profiling by array\n")
+            f.write("!Series_contributor = Synthetic,,Author\n")
+            f.writelines("!Series_sample_id = " + gsm + "\n" for gsm in gsms)
+            f.writelines("!Series_platform_id = " + gpl + "\n" for gpl in gpls)
+            for gpl in gpls:
+                f.write("^PLATFORM = " + gpl + "\n!Platform_geo_accession = " + gpl + "\n")
+                f.write("!Platform_organism = Vitis vinifera\n#ID = probe identifier\n")
+                f.write("!platform_table_begin\nID\tSEQUENCE\n")
+                f.writelines("PROBE" + str(r) + "\t" + "".join(rng.choice("ACGT") for _ in range(25)) + "\n"
+                             for r in range(platform_rows))
+                f.write("!platform_table_end\n")
+            for gsm in gsms:
+                f.write("^SAMPLE = " + gsm + "\n!Sample_geo_accession = " + gsm + "\n")
+                f.write("!Sample_description = Synthetic sample " + gsm + "\n")
+                f.write("!sample_table_begin\nID_REF\tVALUE\n")
+                f.writelines("PROBE" + str(r) + "\t" + str(round(rng.random() * 1000, 3)) + "\n"
+                             for r in range(sample_rows))
+                f.write("!sample_table_end\n")
+
+        accession = "E-SYNT-" + str(n)
+        with open(path + accession + ".sdrf.txt", "w", encoding="utf-8") as f:
+            f.write("Source Name\tCharacteristics [organism]\tDescription\tComment [Platform_title]\n")
+            f.writelines("S" + str(s) + "\tVitis vinifera\tSynthetic sample " + str(s) + "\tSynthetic platform\n"
+                         for s in range(samples))
+        with open(path + accession + ".idf.txt", "w", encoding="utf-8") as f:
+            f.write("Investigation Title\tSynthetic study " + str(n) + "\n")
+            f.write("Person Last Name\tAuthor\nPerson First Name\tSynthetic\n")
+            f.write("Experiment Description\tSynthetic design of study " + str(n) + "\n")
+            f.write("Comment[AEExperimentType]\ttranscription profiling by array\n")
+
+
+class Benchmark:
+    """
+    This class times each stage of the pipeline on a staging area and records its peak memory (tracemalloc): SOFT
+    parsing (transformGEO), SDRF parsing (as in transformArrayExpress), JSON serialization (createFile) and loading
+    (load_data, only when a MongoDB connection is given). The results are kept as a dictionary that can be saved as a
+    JSON file and compared with the results of another run.
+    """
+
+    def __init__(self, staging_path: str = "staging_area/", repeat: int = 1):
+        """
+        :param staging_path: staging area folder with the files to transform
+        :param repeat: number of timed runs of each stage (the fastest is kept)
+        """
+        self.staging_path = staging_path
+        self.repeat = repeat
+        self.transf = None
+        self.results = {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "staging_path": staging_path,
+            "stages": {}
+        }
+
+    def measure(self, stage: str, function, items: int) -> None:
+        """
+        This method runs a stage and records its duration and peak memory. The duration is measured without
+        tracemalloc, which slows Python down, and the peak memory in one extra run.
+        :param stage: name of the stage
+        :param function: function without arguments that runs the stage
+        :param items: number of files or datasets processed by the stage
+        """
+        seconds = None
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        self.results["stages"][stage] = {"seconds": round(seconds, 4), "peak_bytes": peak, "items": items,
+                                         "items_per_second": round(items / seconds, 2) if seconds > 0 else None}
+
+    def run(self, mongo_host: str = None) -> dict:
+        """
+        This method runs all the stages
+        :param mongo_host: MongoDB connection string of a test database (e.g. "mongodb://localhost:27017/benchmark")
+        or "mongomock" for an in-memory database; if None, the load stage is skipped
+        :return: the results
+        """
+        def transform_geo():
+            self.transf = Transform()
+            self.transf.file_path = self.staging_path
+            self.transf.transformGEO()
+
+        softfiles = [f for f in os.listdir(self.staging_path) if ".soft.gz" in f]
+        self.measure("soft_parse", transform_geo, len(softfiles))
+
+        sdrf_files = [self.staging_path + f for f in os.listdir(self.staging_path) if ".sdrf.txt" in f]
+        self.measure("sdrf_parse", lambda: [parse_sdrf(f) for f in sdrf_files], len(sdrf_files))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            self.measure("json_serialize", lambda: self.transf.createFile(os.path.join(tmp, "dataset.json")),
+                         len(self.transf.dictionaryPrincipal))
+
+        if mongo_host is not None:
+            import mongoengine
+            import Mongo_schema_Load
+            mongoengine.disconnect()
+            if mongo_host == "mongomock":
+                import mongomock
+                mongoengine.connect("benchmark", mongo_client_class=mongomock.MongoClient)
+            else:
+                mongoengine.connect(host=mongo_host)
+
+            def load():
+                # every run starts from empty collections, otherwise the unchanged datasets would be skipped
+                Mongo_schema_Load.Transcriptomics.drop_collection()
+                Mongo_schema_Load.TranscriptomicsSample.drop_collection()
+                counts = Mongo_schema_Load.load_data(self.transf.dictionaryPrincipal)
+                if counts["inserted"] != len(self.transf.dictionaryPrincipal):
+                    raise RuntimeError("load stage inserted " + str(counts["inserted"]) + " of " +
+                                       str(len(self.transf.dictionaryPrincipal)) + " datasets")
+
+            self.measure("load", load, len(self.transf.dictionaryPrincipal))
+        return self.results
+
+    def save(self, filename: str) -> None:
+        """
+        :param filename: name of the JSON file where the results are written
+        """
+        with open(filename, "w", encoding="utf-8") as outfile:
+            json.dump(self.results, outfile, indent=1)
+
+
+def import_times(modules: tuple = STARTUP_MODULES, repeat: int = 3) -> dict:
+    """
+    This function measures the time to import each module in a new Python process, as a scheduled run or a worker
+    process pays it. No configuration file or database is needed: they are only used when a task runs.
+    :param modules: names of the modules of this folder to import
+    :param repeat: number of imports of each module (the fastest is kept)
+    :return: dictionary with the import time (seconds) of each module
+    """
+    code = "import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)"
+    folder = os.path.dirname(os.path.abspath(__file__))
+    times = {}
+    for module in modules:
+        times[module] = min(float(subprocess.run([sys.executable, "-c", code.format(module)], cwd=folder, check=True,
+                                                 capture_output=True, text=True).stdout)
+                            for _ in range(repeat))
+    return times
+
+
+def compare(baseline_file: str, current_file: str, tolerance: float = 0.2) -> list:
+    """
+    This function compares the results of two benchmark runs
+    :param baseline_file: JSON file with the results of the reference run
+    :param current_file: JSON file with the results of the new run
+    :param tolerance: relative increase of the duration or peak memory of a stage above which it is a regression
+    :return: list of the regressions found, as (stage, measure, baseline value, current value) tuples
+    """
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = json.load(f)["stages"]
+    with open(current_file, encoding="utf-8") as f:
+        current = json.load(f)["stages"]
+
+    regressions = []
+    for stage, result in current.items():
+        if stage not in baseline:
+            continue
+        for measure in ("seconds", "peak_bytes"):
+            if result[measure] > baseline[stage][measure] * (1 + tolerance):
+                regressions.append((stage, measure, baseline[stage][measure], result[measure]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the pipeline stages")
+    parser.add_argument("--staging", default="staging_area/", help="staging area to benchmark")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="number of synthetic datasets of each source to generate (in a temporary staging area)")
+    parser.add_argument("--samples", type=int, default=20, help="samples of each synthetic dataset")
+    parser.add_argument("--platforms", type=int, default=1, help="platforms of each synthetic GEO dataset")
+    parser.add_argument("--platform-rows", type=int, default=1000, help="rows of each synthetic platform table")
+    parser.add_argument("--sample-rows", type=int, default=1000, help="rows of each synthetic sample table")
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs of each stage (the fastest is kept)")
+    parser.add_argument("--mongo", default=None, help='MongoDB connection string or "mongomock" for the load stage')
+    parser.add_argument("--output", default="benchmark.json", help="JSON file with the results")
+    parser.add_argument("--compare", default=None, help="JSON file with the results of a previous run")
+    parser.add_argument("--import-budget", type=float, default=None,
+                        help="only check that each startup module is imported in less than this number of seconds")
+    args = parser.parse_args()
+
+    if args.import_budget is not None:
+        over_budget = False
+        for module, seconds in import_times().items():
+            print(module + ": " + str(round(seconds, 3)) + " s")
+            if seconds > args.import_budget:
+                print("IMPORT BUDGET EXCEEDED " + module + ": " + str(round(seconds, 3)) + " s > " +
+                      str(args.import_budget) + " s")
+                over_budget = True
+        sys.exit(1 if over_budget else 0)
+
+    with tempfile.TemporaryDirectory() as synthetic_path:
+        staging = args.staging
+        if args.synthetic:
+            staging = synthetic_path + "/"
+            write_synthetic_staging(staging, args.synthetic, args.samples, args.platforms, args.platform_rows,
+                                    args.sample_rows)
+        benchmark = Benchmark(staging, args.repeat)
+        benchmark.results["synthetic"] = vars(args) if args.synthetic else None
+        print(json.dumps(benchmark.run(args.mongo), indent=1))
+        benchmark.save(args.output)
+
+    if args.compare:
+        for stage, measure, before, after in compare(args.compare, args.output):
+            print("REGRESSION " + stage + " " + measure + ": " + str(before) + " -> " + str(after))
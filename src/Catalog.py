@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+
+# fields of the datasets table, in the order of its columns
+DATASET_FIELDS = ("accession_number", "database", "title", "data_type", "organism", "last_update_date",
+                  "overall_design")
+
+
+class Catalog:
+    """
+    This class keeps the transformed datasets in a local SQLite database, to search them without the target database
+    on MongoDB. The datasets are stored in four tables (datasets, platforms, contributors and samples) and the title,
+    overall design and sample descriptions of each dataset are indexed for full text search (FTS5). Writing the same
+    datasets again only updates the ones that changed.
+    """
+
+    def __init__(self, path: str = "data/catalog.sqlite"):
+        """
+        :param path: path to the SQLite file of the catalog
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS datasets (accession_number TEXT PRIMARY KEY, database TEXT, title TEXT,
+                data_type TEXT, organism TEXT, last_update_date TEXT, overall_design TEXT, sample_count INTEGER,
+                content_hash TEXT);
+            CREATE INDEX IF NOT EXISTS datasets_organism ON datasets (organism);
+            CREATE INDEX IF NOT EXISTS datasets_data_type ON datasets (data_type);
+            CREATE TABLE IF NOT EXISTS platforms (accession_number TEXT, platform_id TEXT,
+                PRIMARY KEY (accession_number, platform_id));
+            CREATE INDEX IF NOT EXISTS platforms_platform_id ON platforms (platform_id);
+            CREATE TABLE IF NOT EXISTS contributors (accession_number TEXT, position INTEGER, name TEXT,
+                PRIMARY KEY (accession_number, position));
+            CREATE INDEX IF NOT EXISTS contributors_name ON contributors (name);
+            CREATE TABLE IF NOT EXISTS samples (accession_number TEXT, sample_id TEXT, description TEXT,
+                PRIMARY KEY (accession_number, sample_id));
+            CREATE VIRTUAL TABLE IF NOT EXISTS datasets_fts USING fts5 (accession_number UNINDEXED, title,
+                overall_design, samples);
+        """)
+
+    def close(self) -> None:
+        """
+        This method closes the connection to the catalog
+        """
+        self.connection.close()
+
+    @staticmethod
+    def dataset_hash(dataset: dict) -> str:
+        """
+        :param dataset: transformed dataset
+        :return: hexadecimal SHA-256 hash of the dataset, used to skip the datasets that did not change
+        """
+        content = json.dumps(dataset, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def upsert(self, datasets) -> dict:
+        """
+        This method inserts the new datasets and replaces the changed ones, in one transaction
+        :param datasets: iterable of transformed datasets, e.g. the values of Transform.dictionaryPrincipal or the
+        generator of Mongo_schema_Load.read_ndjson_database
+        :return: dictionary with the number of inserted, updated and unchanged datasets
+        """
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        stored = {row[0]: row[1] for row in self.connection.execute(
+            "SELECT accession_number, content_hash FROM datasets")}
+        with self.connection:
+            for dataset in datasets:
+                accession = dataset["accession_number"]
+                value_hash = self.dataset_hash(dataset)
+                if stored.get(accession) == value_hash:
+                    counts["unchanged"] += 1
+                    continue
+                if accession in stored:
+                    self.delete(accession)
+                    counts["updated"] += 1
+                else:
+                    counts["inserted"] += 1
+                stored[accession] = value_hash
+
+                samples = dataset.get("samples") or {}
+                self.connection.execute("INSERT INTO datasets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        [dataset.get(field) for field in DATASET_FIELDS] +
+                                        [len(samples), value_hash])
+                self.connection.executemany("INSERT OR IGNORE INTO platforms VALUES (?, ?)",
+                                            [(accession, platform) for platform in dataset.get("platform_id") or []])
+                self.connection.executemany("INSERT INTO contributors VALUES (?, ?, ?)",
+                                            [(accession, i, name)
+                                             for i, name in enumerate(dataset.get("contributors") or [])])
+                self.connection.executemany("INSERT INTO samples VALUES (?, ?, ?)",
+                                            [(accession, sample_id, description)
+                                             for sample_id, description in samples.items()])
+                self.connection.execute("INSERT INTO datasets_fts VALUES (?, ?, ?, ?)",
+                                        (accession, dataset.get("title"), dataset.get("overall_design"),
+                                         " ".join(description for description in samples.values() if description)))
+        return counts
+
+    def delete(self, accession: str) -> None:
+        """
+        This method removes a dataset from all the tables of the catalog
+        :param accession: accession number of the dataset
+        """
+        for table in ("datasets", "platforms", "contributors", "samples", "datasets_fts"):
+            self.connection.execute("DELETE FROM " + table + " WHERE accession_number = ?", (accession,))
+
+    def find(self, organism: str = None, data_type: str = None, platform_id: str = None, database: str = None,
+             contributor: str = None, limit: int = None) -> list:
+        """
+        This method lists the datasets that match all the given conditions
+        :param organism: organism of the datasets
+        :param data_type: data type of the datasets
+        :param platform_id: platform used by the datasets
+        :param database: source database of the datasets (GEO or ArrayExpress)
+        :param contributor: name of a contributor of the datasets
+        :param limit: maximum number of datasets listed
+        :return: list with the summary of each dataset (the fields of the datasets table), by accession number
+        """
+        conditions = []
+        values = []
+        for field, value in (("organism", organism), ("data_type", data_type), ("database", database)):
+            if value is not None:
+                conditions.append(field + " = ?")
+                values.append(value)
+        if platform_id is not None:
+            conditions.append("accession_number IN (SELECT accession_number FROM platforms WHERE platform_id = ?)")
+            values.append(platform_id)
+        if contributor is not None:
+            conditions.append("accession_number IN (SELECT accession_number FROM contributors WHERE name = ?)")
+            values.append(contributor)
+
+        query = "SELECT * FROM datasets"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY accession_number"
+        if limit is not None:
+            query += " LIMIT ?"
+            values.append(limit)
+        return [self.summary(row) for row in self.connection.execute(query, values)]
+
+    @staticmethod
+    def fts_query(text: str) -> str:
+        """
+        :param text: words typed by a user, e.g. 'RNA-seq cv. Pinot'
+        :return: FTS5 query where each word is a quoted string, so that punctuation such as "-", "." or ":" is not read
+        as FTS5 syntax (the datasets must have all the words)
+        """
+        return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+    def search(self, text: str, limit: int = 20, raw: bool = False) -> list:
+        """
+        This method searches the title, overall design and sample descriptions of the datasets
+        :param text: words searched, e.g. 'berry ripening' (both words) or 'RNA-seq' (see fts_query)
+        :param limit: maximum number of datasets listed
+        :param raw: if True, text is a FTS5 query, e.g. '"cold stress"' (phrase), 'leaf OR root' or 'title: leaf'
+        (an invalid query raises sqlite3.OperationalError)
+        :return: list with the summary of each dataset found, the most relevant first
+        """
+        if not raw:
+            text = self.fts_query(text)
+            if not text:
+                return []
+        query = ("SELECT datasets.* FROM datasets_fts JOIN datasets USING (accession_number) "
+                 "WHERE datasets_fts MATCH ? ORDER BY bm25(datasets_fts) LIMIT ?")
+        return [self.summary(row) for row in self.connection.execute(query, (text, limit))]
+
+    def get(self, accession: str) -> dict:
+        """
+        :param accession: accession number of the dataset
+        :return: the dataset with the same fields as in the JSON file created by Transform, or None if it is not in
+        the catalog
+        """
+        row = self.connection.execute("SELECT * FROM datasets WHERE accession_number = ?", (accession,)).fetchone()
+        if row is None:
+            return None
+        dataset = {field: row[field] for field in DATASET_FIELDS}
+        dataset["platform_id"] = [r[0] for r in self.connection.execute(
+            "SELECT platform_id FROM platforms WHERE accession_number = ? ORDER BY rowid", (accession,))]
+        dataset["contributors"] = [r[0] for r in self.connection.execute(
+            "SELECT name FROM contributors WHERE accession_number = ? ORDER BY position", (accession,))]
+        dataset["samples"] = {r[0]: r[1] for r in self.connection.execute(
+            "SELECT sample_id, description FROM samples WHERE accession_number = ? ORDER BY rowid", (accession,))}
+        return dataset
+
+    def count(self) -> int:
+        """
+        :return: number of datasets in the catalog
+        """
+        return self.connection.execute("SELECT COUNT(*) FROM datasets").fetchone()[0]
+
+    @staticmethod
+    def summary(row: sqlite3.Row) -> dict:
+        """
+        :param row: row of the datasets table
+        :return: the summary of the dataset (without the content hash)
+        """
+        summary = dict(row)
+        del summary["content_hash"]
+        return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search the local catalog of the transformed datasets")
+    parser.add_argument("text", nargs="?", default=None, help="words searched in the titles, designs and samples")
+    parser.add_argument("--catalog", default="data/catalog.sqlite", help="SQLite file of the catalog")
+    parser.add_argument("--organism", default=None)
+    parser.add_argument("--data-type", default=None)
+    parser.add_argument("--platform", default=None)
+    parser.add_argument("--database", default=None)
+    parser.add_argument("--contributor", default=None)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--raw", action="store_true",
+                        help="read the text as a FTS5 query (phrases in quotes, OR, NOT, column: words, prefix*)")
+    args = parser.parse_args()
+
+    catalog = Catalog(args.catalog)
+    if args.text:
+        try:
+            results = catalog.search(args.text, args.limit, args.raw)
+        except sqlite3.OperationalError as e:
+            catalog.close()
+            sys.exit("INVALID SEARCH " + repr(args.text) + ": " + str(e))
+    else:
+        results = catalog.find(args.organism, args.data_type, args.platform, args.database, args.contributor,
+                               args.limit)
+    for result in results:
+        print(result["accession_number"] + "\t" + (result["organism"] or "") + "\t" + (result["title"] or ""))
+    catalog.close()
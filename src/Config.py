@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import os
+from configparser import RawConfigParser
+from functools import lru_cache
+
+# configuration file of the pipeline, which can be replaced with the IPLANTSDB_OMICS_CONF environment variable
+CONFIG_FILE = "/iplantsdb_omics/conf/iplantsdb_omics.conf"
+SECTION = "iplants-omics-configurations"
+
+# process that opened the MongoDB connection (a connection cannot be shared with forked processes)
+connection_pid = None
+
+
+@lru_cache(maxsize=None)
+def read_configs() -> RawConfigParser:
+    """
+    This function reads the configuration file once, the first time a setting is needed
+    :return: the configurations read
+    """
+    db_configs = RawConfigParser()
+    db_configs.read(os.environ.get("IPLANTSDB_OMICS_CONF", CONFIG_FILE))
+    return db_configs
+
+
+def get_config(option: str, fallback: str = None) -> str:
+    """
+    :param option: name of the setting in the configuration file
+    :param fallback: value returned if the setting is not in the file (if None, a missing setting raises an error)
+    :return: the value of the setting
+    """
+    if fallback is None:
+        return str(read_configs().get(SECTION, option))
+    return str(read_configs().get(SECTION, option, fallback=fallback))
+
+
+def connect_mongodb():
+    """
+    This function connects to the target database on the first call of each process and returns the same connection
+    (a pool of connections shared by the threads) on the next calls. A connection opened before (e.g. with mongoengine
+    connect) is used instead.
+    :return: the MongoDB client of the connection
+    """
+    global connection_pid
+    from mongoengine import connect, disconnect
+    from mongoengine.connection import ConnectionFailure, get_connection
+
+    if connection_pid not in (None, os.getpid()):
+        # the connection was inherited from the parent process: it is replaced by a new one
+        disconnect()
+        connection_pid = None
+    try:
+        return get_connection()
+    except ConnectionFailure:
+        pass
+
+    connection_pid = os.getpid()
+    return connect(get_config("mongodb_name"), host=get_config("mongodb_host"), port=int(get_config("mongodb_port")),
+                   maxPoolSize=int(get_config("mongodb_pool_size", "100")))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import gzip
+import os
+import tempfile
+import threading
+import time
+from contextlib import nullcontext
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from Metrics import METRICS
+
+# HTTP status codes worth retrying: throttling and temporary server errors
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """
+    This class implements a token bucket shared by the download threads, so that no more than rate requests per second
+    are sent to a server (NCBI allows 3 requests per second without an API key)
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        """
+        :param rate: number of requests allowed per second
+        :param capacity: maximum number of requests that can be sent in a burst
+        """
+        self.rate = rate
+        self.capacity = capacity
+        # the bucket starts empty, so that a downloader created right after another one (e.g. by the next task of the
+        # workflow) does not send a burst over the rate
+        self.tokens = 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        This method blocks until a token is available and takes it
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Downloader:
+    """
+    This class downloads files from the external sources with a bounded pool of threads, reusing HTTP connections
+    (one keep-alive session per thread), limiting the request rate, retrying failed requests with exponential backoff
+    and writing each file atomically (a temporary file renamed once complete)
+    """
+
+    def __init__(self, workers: int = 4, rate: float = 3.0, retries: int = 3, backoff: float = 1.0,
+                 timeout: float = 60.0):
+        """
+        :param workers: number of download threads
+        :param rate: maximum number of requests per second
+        :param retries: number of times a failed request is retried
+        :param backoff: seconds to wait before the first retry, doubled at each new retry
+        :param timeout: seconds to wait for the server to connect or send data
+        """
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def session(self) -> requests.Session:
+        """
+        :return: the HTTP session of the current thread, created on first use
+        """
+        if not hasattr(self.local, "session"):
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self.local.session = session
+        return self.local.session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        This method sends a request, respecting the rate limit and retrying on connection errors, throttling (429)
+        and server errors (5xx)
+        :param method: HTTP method ("GET", "HEAD", ...)
+        :param url: URL to request
+        :param kwargs: other arguments of requests.Session.request (params, stream, ...)
+        :return: the successful response
+        """
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                with METRICS.timer("http_request_seconds", url, method=method, host=urlparse(url).netloc):
+                    response = self.session().request(method, url, timeout=self.timeout, **kwargs)
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    return response
+                error = requests.HTTPError(f"{response.status_code} for url: {url}", response=response)
+                retry_after = response.headers.get("Retry-After")
+                response.close()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                retry_after = None
+
+            METRICS.increment("http_errors", host=urlparse(url).netloc)
+            if attempt >= self.retries:
+                raise error
+            wait = self.backoff * 2 ** attempt
+            if retry_after is not None and retry_after.isdigit():
+                wait = max(wait, int(retry_after))
+            time.sleep(wait)
+            attempt += 1
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        This method sends a GET request (see request)
+        :param url: URL to request
+        :param kwargs: other arguments of requests.Session.get (params, stream, ...)
+        :return: the successful response
+        """
+        return self.request("GET", url, **kwargs)
+
+    def last_modified(self, url: str) -> str:
+        """
+        This method asks the server when a file was last changed, without downloading it
+        :param url: URL of the file
+        :return: the Last-Modified header of the file, or None if the server does not send it
+        """
+        response = self.request("HEAD", url, allow_redirects=True)
+        return response.headers.get("Last-Modified")
+
+    def download(self, url: str, filepath: str, compress: bool = False) -> None:
+        """
+        This method downloads a file. The content is streamed into a temporary file in the same folder, which is only
+        renamed to filepath when complete, so an interrupted download never leaves a truncated file behind. A download
+        interrupted while streaming (connection dropped or read timeout) is started again, with the same retries and
+        backoff as the requests.
+        :param url: URL of the file
+        :param filepath: path where the file is saved
+        :param compress: if True, the file is saved gzipped (for content that the server does not compress)
+        """
+        folder = os.path.dirname(filepath) or "."
+        os.makedirs(folder, exist_ok=True)
+        attempt = 0
+        while True:
+            # the errors of the request itself are retried by get, only the interrupted streams are retried here
+            with self.get(url, stream=True) as response:
+                fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".", suffix=".part")
+                try:
+                    with os.fdopen(fd, "wb") as tmp_file, \
+                            (gzip.GzipFile(fileobj=tmp_file, mode="wb") if compress else nullcontext(tmp_file)) as out:
+                        for chunk in response.iter_content(chunk_size=1 << 16):
+                            out.write(chunk)
+                            METRICS.increment("downloaded_bytes", len(chunk))
+                    os.replace(tmp_path, filepath)
+                    return
+                except (requests.exceptions.ChunkedEncodingError, requests.ConnectionError, requests.Timeout):
+                    os.remove(tmp_path)
+                    METRICS.increment("http_errors", host=urlparse(url).netloc)
+                    if attempt >= self.retries:
+                        raise
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
@@ -1,17 +1,37 @@
 # -*- coding: utf-8 -*-
 
 # Import required modules
-from Bio import Entrez
-import GEOparse
+import io
+import json
+import os
 import re
-import requests
+import time
+from concurrent.futures import ThreadPoolExecutor
+from Config import get_config
+from Downloader import Downloader
+from Manifest import Manifest
+from Metrics import METRICS
+from ResponseCache import ResponseCache
 
-from configparser import RawConfigParser
+# base URLs of the external sources, which can be replaced (e.g. by the local stand-in servers of MockServices)
+DEFAULT_URLS = {
+    "esearch": "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi",  # NCBI Entrez search
+    "geo_ftp": "https://ftp.ncbi.nlm.nih.gov/geo/",  # NCBI GEO files (family SOFT files)
+    "geo_query": "https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi",  # NCBI GEO records (brief SOFT views)
+    "biostudies": "https://www.ebi.ac.uk/biostudies/",  # BioStudies API and files (ArrayExpress collection)
+}
 
-db_configs = RawConfigParser()
-db_configs.read('/iplantsdb_omics/conf/iplantsdb_omics.conf')
 
-Entrez.email = str(db_configs.get('iplants-omics-configurations', 'entrez_email')),
+def get_entrez():
+    """
+    This function imports Biopython's Entrez module when it is first needed and sets the e-mail sent to NCBI with the
+    requests
+    :return: the Entrez module
+    """
+    from Bio import Entrez
+    if Entrez.email is None:
+        Entrez.email = get_config("entrez_email")
+    return Entrez
 
 
 class Extract:
@@ -20,80 +40,333 @@ class Extract:
     area that corresponds to the attribute path (a folder in the computer)
     """
 
-    def __init__(self, organism: str, data_type: str, study_type: str):
+    def __init__(self, organism: str, data_type: str, study_type: str, workers: int = 4, rate: float = 3.0,
+                 cache: ResponseCache = None, geo_page_size: int = 1000, arrayexpress_page_size: int = 100,
+                 page_workers: int = 2, geo_metadata_only: bool = False, urls: dict = None,
+                 discovery_max_age: float = None):
         """
         :param organism: organism filter to perform a search on GEO and ArrayExpress collection on BioStudies databases
         :param data_type: dataset study type filter to perform a search on GEO database
         :param study_type: dataset study type filter to perform a search on ArrayExpress collection
+        :param workers: number of files downloaded at the same time
+        :param rate: maximum number of download requests per second (NCBI allows 3 without an API key)
+        :param cache: cache of the responses of the search APIs (defaults to a ResponseCache with the default settings)
+        :param geo_page_size: number of accession numbers requested in each page of the GEO search
+        :param arrayexpress_page_size: number of accession numbers requested in each page of the ArrayExpress search
+        :param page_workers: number of search pages requested at the same time
+        :param geo_metadata_only: if True, extract only the metadata of the GEO series, platforms and samples (brief
+        SOFT files, see brief_url) instead of the family SOFT files with their data tables
+        :param urls: base URLs of the external sources, updating DEFAULT_URLS
+        :param discovery_max_age: seconds after which the saved discovery is searched again (defaults to the time to
+        live of the cached esearch responses)
         """
 
         self.organism = organism
         self.data_type = data_type
         self.study_type = study_type
         self.path = "staging_area/"
+        self.downloader = Downloader(workers=workers, rate=rate)
+        self.manifest = Manifest(self.path)
+        self.cache = cache if cache is not None else ResponseCache()
+        self.discovery = None
+        self.discovery_path = "data/discovery/"
+        self.geo_page_size = geo_page_size
+        self.arrayexpress_page_size = arrayexpress_page_size
+        self.page_workers = page_workers
+        self.geo_metadata_only = geo_metadata_only
+        self.urls = dict(DEFAULT_URLS, **(urls or {}))
+        self.discovery_max_age = discovery_max_age if discovery_max_age is not None else self.cache.ttls["esearch"]
+
+    def esearch_page(self, retstart: int) -> dict:
+        """
+        This method requests one page of the search on NCBI GEO database
+        :param retstart: position of the first result of the page
+        :return: the esearch record of the page (Count, IdList, ...)
+        """
+
+        query = f"{self.organism} [Organism] AND {self.data_type} [DataSet Type]"
+
+        # Search, using the cached response if the same search was done before
+        params = {"db": "gds", "term": query, "retstart": retstart, "retmax": self.geo_page_size}
+        Entrez = get_entrez()
+
+        def esearch():
+            # sent by the downloader, with its rate limit and retries, and identified as Entrez requires
+            return self.downloader.get(self.urls["esearch"],
+                                       params=dict(params, tool="iplantsdb_omics", email=Entrez.email)).content
+
+        raw = self.cache.fetch("esearch", self.urls["esearch"], params, esearch)
+        return Entrez.read(io.BytesIO(raw))
+
+    def iter_geo_accession(self):
+        """
+        This method searches NCBI GEO database page by page, until all the results are read. The first page gives the
+        number of results and the next pages are requested page_workers at a time.
+        :return: generator of the dataset accession numbers, which is as result of the filter combination of organism
+        and dataset type
+        """
+        uid_regex = re.compile(r"[1-9]+0+([1-9]+\d*)")
+        first = self.esearch_page(0)
+        for uid in first["IdList"]:
+            yield "GSE" + uid_regex.match(uid).group(1)
+
+        count = int(first["Count"])
+        with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+            for record in executor.map(self.esearch_page, range(self.geo_page_size, count, self.geo_page_size)):
+                for uid in record["IdList"]:
+                    yield "GSE" + uid_regex.match(uid).group(1)
 
     def get_geo_accession(self) -> list:
         """
         :return: retrieve a list of dataset accession numbers from NCBI GEO database, which is as result of the filter
         combination of organism and dataset type
         """
+        return list(self.iter_geo_accession())
 
-        query = f"{self.organism} [Organism] AND {self.data_type} [DataSet Type]"
+    def download_softfiles(self, refresh: bool = False) -> None:
+        """
+        This method uses a list of GEO accession numbers to extract the correspondents softfiles from NCBI GEO database,
+        downloading only the new or updated ones
+        :param refresh: if True, search the database again (see discover); the downloads start as the search pages
+        arrive, before the search is complete
+        """
+        if refresh or self.discovery_saved() is None:
+            geo = []
+
+            def datasets():
+                for access in self.iter_geo_accession():
+                    geo.append(access)
+                    yield (access,) + self.dataset_file("GEO", access)
+
+            self.download_updated("GEO", datasets())
+            self.discover(refresh=True, geo=geo)
+        else:
+            self.download_updated("GEO", [(access,) + self.dataset_file("GEO", access)
+                                          for access in self.discover()["geo"]])
+
+    def softfile_url(self, accession: str) -> str:
+        """
+        :param accession: GEO series accession number (GSE)
+        :return: URL of the family SOFT file of the series on the NCBI GEO FTP site (e.g. GSE103226 is in the
+        GSE103nnn folder)
+        """
+        range_subdir = re.sub(r"\d{1,3}$", "nnn", accession)
+        return (self.urls["geo_ftp"] + "series/" + range_subdir + "/" + accession + "/soft/" +
+                accession + "_family.soft.gz")
+
+    def brief_url(self, accession: str) -> str:
+        """
+        :param accession: GEO series accession number (GSE)
+        :return: URL of the brief view of the series on NCBI GEO: a SOFT text with the metadata of the series and of
+        all its platforms and samples, without the data tables, which are most of the size of the family SOFT files
+        """
+        return self.urls["geo_query"] + "?acc=" + accession + "&targ=all&form=text&view=brief"
+
+    def dataset_file(self, source: str, accession: str) -> tuple:
+        """
+        :param source: database of the dataset (GEO or ArrayExpress)
+        :param accession: accession number of the dataset
+        :return: tuple with the URL of the file of the dataset (the family SOFT file for GEO, or the brief SOFT file if
+        only the metadata is extracted, the SDRF file for ArrayExpress) and its path in the staging area
+        """
+        if source == "GEO" and self.geo_metadata_only:
+            return self.brief_url(accession), self.path + accession + "_brief.soft.gz"
+        if source == "GEO":
+            return self.softfile_url(accession), self.path + accession + "_family.soft.gz"
+        return (self.urls["biostudies"] + "files/" + accession + "/" + accession + ".sdrf.txt",
+                self.path + accession + ".sdrf.txt")
+
+    def idf_file(self, accession: str) -> tuple:
+        """
+        :param accession: ArrayExpress accession number of the dataset
+        :return: tuple with the URL of the IDF file of the dataset, which has its study metadata (title, type,
+        authors, design), and its path in the staging area
+        """
+        return (self.urls["biostudies"] + "files/" + accession + "/" + accession + ".idf.txt",
+                self.path + accession + ".idf.txt")
 
-        # Search, using history results if cached before
-        handle = Entrez.esearch(db="gds", term=query, usehistory=True, retmax=1000)
-        record = Entrez.read(handle)
-        list_ids = record["IdList"]
-        handle.close()
-        uid_regex = re.compile("[1-9]+0+([1-9]+\d*)")
-        gse_list = ["GSE" + uid_regex.match(uid).group(1) for uid in list_ids]
-        return gse_list
+    def arrayexpress_page(self, page: int) -> dict:
+        """
+        This method requests one page of the search on ArrayExpress collection
+        :param page: number of the page, starting at 1
+        :return: the decoded JSON page (totalHits, hits, ...)
+        """
+        api_url = (self.urls["biostudies"] + 'api/v1/arrayexpress/search?pageSize=' +
+                   str(self.arrayexpress_page_size) + '&page=' + str(page) + '&study_type="' + self.study_type +
+                   '"&organism="' + self.organism + '"')
+        raw = self.cache.fetch("biostudies_search", api_url, request=lambda: self.downloader.get(api_url).content)
+        return json.loads(raw)
 
-    def download_softfiles(self) -> None:
+    def iter_arrayexpress(self):
         """
-        This method uses a list of GEO accession numbers to extract the correspondents softfiles from NCBI GEO database
+        This method perform a restricted search by organism and study type on ArrayExpress collection through a REST
+        API, page by page until all the results are read. The first page gives the number of results and the next
+        pages are requested page_workers at a time.
+        :return: generator of the ArrayExpress accession numbers
         """
-        for access in self.get_geo_accession():
-            GEOparse.get_GEO(geo=access, destdir=self.path)  # Get GSE object
+        first = self.arrayexpress_page(1)
+        for i in first["hits"]:
+            yield i["accession"]
+
+        pages = -(-int(first.get("totalHits", 0)) // self.arrayexpress_page_size)
+        with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+            for file in executor.map(self.arrayexpress_page, range(2, pages + 1)):
+                for i in file["hits"]:
+                    yield i["accession"]
 
     def get_arrayexpress(self) -> list:
         """
         This method perform a restricted search by organism and study type on ArrayExpress collection through a REST API
         :return: a list with the ArrayExpress accession numbers
         """
-        api_url = ('https://www.ebi.ac.uk/biostudies/api/v1/arrayexpress/search?pageSize=100&study_type="' +
-                   self.study_type + '"&organism="' + self.organism + '"')
-        response = requests.get(api_url)
-        file = response.json()
-        info = file["hits"]
-        accession = []
-        for i in info:
-            accession.append(i["accession"])
-        return accession
+        return list(self.iter_arrayexpress())
+
+    def discovery_file(self) -> str:
+        """
+        :return: path to the file where the accession numbers found for the organism and study types are kept
+        """
+        name = re.sub(r"\W+", "_", f"{self.organism}_{self.data_type}_{self.study_type}").strip("_").lower()
+        return self.discovery_path + name + ".json"
+
+    def discovery_saved(self) -> dict:
+        """
+        :return: the saved discovery of the organism and study types (see discover), or None if there is none or it is
+        older than discovery_max_age (the databases are then searched again)
+        """
+        if self.discovery is None and os.path.isfile(self.discovery_file()):
+            with open(self.discovery_file(), encoding="utf-8") as discovery_file:
+                discovery = json.load(discovery_file)
+            if time.time() - discovery.get("searched", 0) <= self.discovery_max_age:
+                self.discovery = discovery
+        return self.discovery
+
+    def discover(self, refresh: bool = False, geo: list = None) -> dict:
+        """
+        This method searches GEO and ArrayExpress for the organism and study types and reconciles both lists of
+        accession numbers. The result is saved, so that the search is done once per run and the next stages (SDRF
+        download, transform) use the saved accession numbers instead of searching again.
+        :param refresh: if True, search the databases again even if there are saved results
+        :param geo: GEO accession numbers already searched, if any (the GEO search is then not repeated)
+        :return: dictionary with the GEO accession numbers ("geo") and the ArrayExpress accession numbers not in common
+        with GEO ("arrayexpress")
+        """
+        if not refresh and self.discovery_saved() is not None:
+            return self.discovery
+
+        with METRICS.timer("discovery_seconds", self.organism + " " + self.study_type):
+            if geo is None:
+                geo = self.get_geo_accession()
+            self.discovery = {
+                "organism": self.organism,
+                "data_type": self.data_type,
+                "study_type": self.study_type,
+                "searched": time.time(),
+                "geo": geo,
+                "arrayexpress": self.reconcile_accessions(geo, self.get_arrayexpress())
+            }
+        METRICS.increment("accessions_found", len(self.discovery["geo"]), source="GEO")
+        METRICS.increment("accessions_found", len(self.discovery["arrayexpress"]), source="ArrayExpress")
+        filename = self.discovery_file()
+        os.makedirs(self.discovery_path, exist_ok=True)
+        with open(filename + ".part", "w", encoding="utf-8") as discovery_file:
+            json.dump(self.discovery, discovery_file, indent=1)
+        os.replace(filename + ".part", filename)
+        return self.discovery
+
+    @staticmethod
+    def normalize_accession(accession: str) -> str:
+        """
+        :param accession: GEO or ArrayExpress accession number
+        :return: the accession number in upper case, with the ArrayExpress imports of GEO series (E-GEOD-x) renamed to
+        their GEO accession number (GSEx)
+        """
+        return re.sub(r"^E-GEOD-", "GSE", accession.strip().upper())
+
+    @staticmethod
+    def reconcile_accessions(geo: list, arrayexpress: list) -> list:
+        """
+        This method compares a list of dataset's GEO and a list of ArrayExpress accession numbers, by exact match of
+        the normalized accession numbers
+        :param geo: list of GEO accession numbers
+        :param arrayexpress: list of ArrayExpress accession numbers
+        :return: list with the normalized ArrayExpress accession numbers not in common with GEO, in the order of the
+        ArrayExpress list and without repetitions
+        """
+        seen = {Extract.normalize_accession(acc) for acc in geo}
+        accessions = []
+        for acc in arrayexpress:
+            x = Extract.normalize_accession(acc)
+            if x not in seen:
+                seen.add(x)
+                accessions.append(x)
+        return accessions
 
     def compare_accessions_array(self) -> list:
         """
         This method uses a list of dataset's GEO and a list of ArrayExpress accession numbers to compare the
         common ones. Based on that, the files with the common ones are extracted by GEO methods and not by ArrayExpress.
+        The accession numbers come from the discovery (see discover), so the databases are only searched once.
         :return: a list with ArrayExpress accession numbers (not in common with GEO)
         """
-        accessions = []
-        geo = self.get_geo_accession()
-        for acc in self.get_arrayexpress():
-            x = re.sub(r"E-GEOD-", "GSE", acc)
-            if not any(x in s for s in geo):
-                accessions.append(x)
-        return accessions
+        return self.discover()["arrayexpress"]
 
     def download_sdrf(self) -> None:
         """
         This method uses a list of ArrayExpress accession numbers not in common with GEO's to download the
-        correspondents' metadata datasets in sdrf files
+        correspondents' metadata datasets in sdrf files, and their study metadata in idf files (recorded in the
+        manifest as "<accession>.idf")
         """
+        datasets = []
         for accession in self.compare_accessions_array():
-            url = "https://www.ebi.ac.uk/biostudies/files/" + accession + "/" + accession + ".sdrf.txt"
-            r = requests.get(url, allow_redirects=True)
-            open(self.path + accession + ".sdrf.txt", "wb").write(r.content)
+            datasets.append((accession,) + self.dataset_file("ArrayExpress", accession))
+            datasets.append((accession + ".idf",) + self.idf_file(accession))
+        self.download_updated("ArrayExpress", datasets)
+
+    def update_file(self, accession: str, url: str, filepath: str) -> tuple:
+        """
+        This method downloads the file of a dataset if it is new or was updated on the external source since it was
+        recorded in the staging area manifest. The update date is asked to the server without downloading the file
+        (Last-Modified header).
+        :param accession: accession number of the dataset
+        :param url: URL of the file
+        :param filepath: path to the file in the staging area
+        :return: tuple with the update date of the file on the external source and True if the manifest entry must be
+        recorded (file downloaded, or already in the staging area but not in the manifest)
+        """
+        try:
+            last_update_date = self.downloader.last_modified(url)
+        except Exception:
+            last_update_date = None
+        if self.manifest.is_current(accession, filepath, last_update_date):
+            METRICS.increment("files_skipped")
+            return last_update_date, False
+        if accession in self.manifest or not os.path.isfile(filepath):
+            with METRICS.timer("download_seconds", accession):
+                # the brief SOFT files are sent as plain text and gzipped in the staging area
+                self.downloader.download(url, filepath, compress=filepath.endswith(".gz") and not url.endswith(".gz"))
+            METRICS.increment("files_downloaded")
+        return last_update_date, True
+
+    def download_updated(self, source: str, datasets) -> None:
+        """
+        This method downloads the files of the datasets that are new or were updated on the external source (see
+        update_file), several at the same time. The datasets can be a generator: each download starts as soon as its
+        dataset is produced. A file that fails to download is reported and does not stop the others.
+        :param source: database from which the files are extracted (GEO or ArrayExpress)
+        :param datasets: iterable of (accession number, URL, file path) tuples
+        """
+        with ThreadPoolExecutor(max_workers=self.downloader.workers) as executor:
+            futures = [(dataset, executor.submit(self.update_file, *dataset)) for dataset in datasets]
+            for (accession, url, filepath), future in futures:
+                error = future.exception()
+                if error is not None:
+                    print("FAILED TO DOWNLOAD " + url + ": " + repr(error))
+                    METRICS.increment("files_failed", source=source)
+                    continue
+                last_update_date, changed = future.result()
+                if changed:
+                    self.manifest.record(accession, source, filepath, last_update_date)
+        self.manifest.save()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+from Benchmark import write_synthetic_staging
+from Extract import Extract
+from Metrics import METRICS
+from MockServices import MockServices
+from ResponseCache import ResponseCache
+
+
+class TimedExtract(Extract):
+    """
+    This class extracts the datasets as Extract does, recording the time taken by each dataset (update date request
+    and download)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+        self.latencies_lock = threading.Lock()
+
+    def update_file(self, accession: str, url: str, filepath: str) -> tuple:
+        start = time.perf_counter()
+        try:
+            return super().update_file(accession, url, filepath)
+        finally:
+            with self.latencies_lock:
+                self.latencies.append(time.perf_counter() - start)
+
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    :param values: sorted list of values
+    :param fraction: fraction of the values below the percentile (e.g. 0.99)
+    :return: the percentile of the values (nearest rank), or None if there are no values
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def counter_total(snapshot: dict, name: str) -> float:
+    """
+    :param snapshot: metrics snapshot (see Metrics.snapshot)
+    :param name: name of a counter
+    :return: the sum of the counter over all its labels
+    """
+    return sum(value for key, value in snapshot["counters"].items() if key == name or key.startswith(name + "{"))
+
+
+class LoadTest:
+    """
+    This class measures the extraction (searches, update date requests and downloads) against the local stand-in
+    servers of MockServices, which serve the files of a staging area with the given latency, error and throttling
+    rates. Each run starts from an empty staging area, manifest and response cache, so every dataset is searched and
+    downloaded again.
+    """
+
+    def __init__(self, staging_path: str = "staging_area/", organism: str = "Vitis vinifera",
+                 data_type: str = "Expression profiling by array", study_type: str = "transcription profiling by array",
+                 workers: int = 4, rate: float = 50.0, retries: int = 3, backoff: float = 0.1,
+                 geo_metadata_only: bool = False, **services):
+        """
+        :param staging_path: staging area with the files served by the stand-in servers
+        :param organism: organism searched (the stand-in servers do not filter by organism)
+        :param data_type: GEO data type searched
+        :param study_type: ArrayExpress study type searched
+        :param workers: number of download threads
+        :param rate: maximum number of requests per second sent by the downloader
+        :param retries: number of times a failed request is retried
+        :param backoff: seconds to wait before the first retry, doubled at each new retry
+        :param geo_metadata_only: if True, extract the brief SOFT views instead of the family SOFT files
+        :param services: arguments of MockServices (latency, jitter, error_rate, throttle_rate, max_rate, ...)
+        """
+        self.staging_path = os.path.abspath(staging_path) + "/"
+        self.organism = organism
+        self.data_type = data_type
+        self.study_type = study_type
+        self.workers = workers
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.geo_metadata_only = geo_metadata_only
+        self.services = services
+
+    def stage(self, extract: TimedExtract, function) -> dict:
+        """
+        This method runs a stage of the extraction and measures it
+        :param extract: extraction object of the stage
+        :param function: function without arguments that runs the stage
+        :return: dictionary with the duration, number of datasets, bytes downloaded, throughput, latency percentiles
+        of the datasets (seconds) and number of failed requests and downloads of the stage
+        """
+        METRICS.reset()
+        extract.latencies = []
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        snapshot = METRICS.snapshot()
+        latencies = sorted(extract.latencies)
+        downloaded = counter_total(snapshot, "downloaded_bytes")
+        return {
+            "seconds": round(seconds, 4),
+            "datasets": len(latencies),
+            "downloaded_bytes": int(downloaded),
+            "datasets_per_second": round(len(latencies) / seconds, 2) if seconds > 0 else None,
+            "megabytes_per_second": round(downloaded / seconds / 1e6, 3) if seconds > 0 else None,
+            "latency": {name: round(value, 4) if value is not None else None for name, value in (
+                ("p50", percentile(latencies, 0.5)), ("p90", percentile(latencies, 0.9)),
+                ("p99", percentile(latencies, 0.99)), ("max", percentile(latencies, 1)))},
+            "http_errors": int(counter_total(snapshot, "http_errors")),
+            "files_failed": int(counter_total(snapshot, "files_failed"))
+        }
+
+    def run(self) -> dict:
+        """
+        This method runs the GEO extraction (search and SOFT files) and the ArrayExpress extraction (search, SDRF and
+        IDF files) in an empty temporary folder
+        :return: the results of each stage and the responses of the stand-in servers by endpoint
+        """
+        # the e-mail sent with the searches is only read from the configuration file for the real NCBI servers
+        from Bio import Entrez
+        if Entrez.email is None:
+            Entrez.email = "load-test@localhost"
+
+        services = MockServices(self.staging_path, **self.services)
+        urls = services.start()
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                extract = TimedExtract(self.organism, self.data_type, self.study_type, workers=self.workers,
+                                       rate=self.rate, cache=ResponseCache(),
+                                       geo_metadata_only=self.geo_metadata_only, urls=urls)
+                extract.downloader.retries = self.retries
+                extract.downloader.backoff = self.backoff
+                results = {
+                    "settings": {"workers": self.workers, "rate": self.rate, "retries": self.retries,
+                                 "backoff": self.backoff, "geo_metadata_only": self.geo_metadata_only,
+                                 "services": self.services},
+                    "stages": {
+                        "geo": self.stage(extract, lambda: extract.download_softfiles(refresh=True)),
+                        "arrayexpress": self.stage(extract, extract.download_sdrf)
+                    }
+                }
+            finally:
+                # the temporary folder is deleted after leaving it
+                os.chdir(cwd)
+                services.stop()
+        results["services"] = services.stats
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the extraction against local stand-in servers of NCBI "
+                                                 "and BioStudies")
+    parser.add_argument("--staging", default="staging_area/", help="staging area with the files served")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="number of synthetic datasets of each source to serve instead (see Benchmark)")
+    parser.add_argument("--workers", type=int, default=4, help="download threads")
+    parser.add_argument("--rate", type=float, default=50.0, help="maximum requests per second of the downloader")
+    parser.add_argument("--retries", type=int, default=3, help="retries of each failed request")
+    parser.add_argument("--backoff", type=float, default=0.1, help="seconds before the first retry")
+    parser.add_argument("--metadata-only", action="store_true", help="extract the brief SOFT views")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of delay of each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximum random seconds added to the delay")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of responses with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of responses with 429")
+    parser.add_argument("--max-rate", type=float, default=None,
+                        help="requests per second accepted by the servers (the others get 429)")
+    parser.add_argument("--retry-after", type=int, default=1, help="seconds of the Retry-After header of the 429")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random delays and failures")
+    parser.add_argument("--output", default=None, help="JSON file with the results")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as synthetic_path:
+        staging = args.staging
+        if args.synthetic:
+            staging = synthetic_path + "/"
+            write_synthetic_staging(staging, args.synthetic)
+        load_test = LoadTest(staging, workers=args.workers, rate=args.rate, retries=args.retries,
+                             backoff=args.backoff, geo_metadata_only=args.metadata_only, latency=args.latency,
+                             jitter=args.jitter, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                             max_rate=args.max_rate, retry_after=args.retry_after, seed=args.seed)
+        results = load_test.run()
+
+    for stage, result in results["stages"].items():
+        print(stage.upper() + ": " + str(result["datasets"]) + " files in " + str(result["seconds"]) + " s (" +
+              str(result["datasets_per_second"]) + " files/s, " + str(result["megabytes_per_second"]) + " MB/s), "
+              "p50 " + str(result["latency"]["p50"]) + " s, p99 " + str(result["latency"]["p99"]) + " s, max " +
+              str(result["latency"]["max"]) + " s, " + str(result["http_errors"]) + " HTTP errors, " +
+              str(result["files_failed"]) + " failed")
+    for endpoint, stats in sorted(results["services"].items()):
+        print(endpoint + ": " + str(stats["requests"]) + " requests " + json.dumps(stats["status"]))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as outfile:
+            json.dump(results, outfile, indent=1)
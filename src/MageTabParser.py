@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import re
+
+# version of the parser, to be increased when its results change (the transformed datasets cached are then discarded)
+PARSER_VERSION = 1
+
+
+def normalize_name(name: str) -> str:
+    """
+    This function normalizes a MAGE-TAB column or tag name, so that spelling variants match
+    (e.g. "Comment [Platform_title]" and "comment[platform_title]")
+    :param name: column name of a SDRF file or tag of an IDF file
+    :return: the name in lower case and without spaces
+    """
+    return re.sub(r"\s+", "", name).lower()
+
+
+def parse_idf(filepath: str) -> dict:
+    """
+    This function reads an IDF (Investigation Description Format) file, where each line is a tag followed by its
+    values, separated by tabs
+    :param filepath: path to the IDF file
+    :return: dictionary where the keys are the normalized tags (see normalize_name) and the values are the lists of
+    values of each tag
+    """
+    idf = {}
+    with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            fields = line.rstrip("\r\n").split("\t")
+            if not fields[0] or fields[0].startswith("#"):
+                continue
+            values = [value.strip().strip('"') for value in fields[1:]]
+            while values and not values[-1]:
+                values.pop()
+            idf.setdefault(normalize_name(fields[0]), []).extend(values)
+    return idf
+
+
+def parse_sdrf(filepath: str) -> dict:
+    """
+    This function reads a SDRF (Sample and Data Relationship Format) file row by row. The header is read once to find
+    the indices of the columns used, and only those columns are kept from each row.
+    :param filepath: path to the SDRF file
+    :return: dictionary with the sample descriptions by sample name ("samples"), and the platforms ("platforms")
+    and organisms ("organisms") of the samples, without repetitions and in the order they appear
+    """
+    sdrf = {"samples": {}, "platforms": [], "organisms": []}
+    with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
+        header = [normalize_name(name) for name in f.readline().rstrip("\r\n").split("\t")]
+        if "sourcename" not in header:
+            return sdrf
+        source_name = header.index("sourcename")
+        description = header.index("description") if "description" in header else None
+        platform = header.index("comment[platform_title]") if "comment[platform_title]" in header else None
+        organism = header.index("characteristics[organism]") if "characteristics[organism]" in header else None
+
+        platforms = set()
+        organisms = set()
+        for line in f:
+            row = line.rstrip("\r\n").split("\t")
+            if len(row) <= source_name or not any(row):
+                continue
+            sdrf["samples"][row[source_name]] = ""
+            if description is not None and description < len(row):
+                sdrf["samples"][row[source_name]] = row[description]
+
+            if platform is not None and platform < len(row) and row[platform] not in platforms:
+                platforms.add(row[platform])
+                sdrf["platforms"].append(row[platform])
+
+            if organism is not None and organism < len(row) and row[organism] and row[organism] not in organisms:
+                organisms.add(row[organism])
+                sdrf["organisms"].append(row[organism])
+    return sdrf
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import hashlib
+import json
+import os
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where the manifest is not locked
+    fcntl = None
+
+
+def file_checksum(filepath: str) -> str:
+    """
+    This function computes the SHA-256 checksum of a file, reading it in blocks
+    :param filepath: path to the file
+    :return: hexadecimal checksum of the file
+    """
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class Manifest:
+    """
+    This class keeps a record of the files in the staging area (a JSON file), so the extraction only downloads the
+    datasets that are new or were updated on the external sources since the last run. For each accession number it
+    stores:
+    - source: database from which the file was extracted (GEO or ArrayExpress)
+    - file: name of the file in the staging area
+    - size: size of the file in bytes
+    - checksum: SHA-256 checksum of the file
+    - last_update_date: date of the last update of the file on the external source (Last-Modified header)
+    """
+
+    def __init__(self, path: str = "staging_area/"):
+        """
+        :param path: staging area folder, where the manifest file is kept
+        """
+        self.filename = path + "manifest.json"
+        self.entries = self.read()
+        self.changed = set()
+
+    def read(self) -> dict:
+        """
+        :return: the entries of the manifest file, or an empty dictionary if there is no manifest yet
+        """
+        if not os.path.isfile(self.filename):
+            return {}
+        with open(self.filename, encoding="utf-8") as manifest_file:
+            return json.load(manifest_file)
+
+    def __contains__(self, accession: str) -> bool:
+        return accession in self.entries
+
+    def is_current(self, accession: str, filepath: str, last_update_date: str) -> bool:
+        """
+        This method checks if the staged file of a dataset is up to date
+        :param accession: accession number of the dataset
+        :param filepath: path to the file of the dataset in the staging area
+        :param last_update_date: date of the last update of the file on the external source (None if unknown)
+        :return: True if the file is in the staging area, unchanged since it was recorded (same size and checksum), and
+        was not updated on the external source
+        """
+        entry = self.entries.get(accession)
+        if entry is None or last_update_date is None or entry["last_update_date"] != last_update_date:
+            return False
+        if not os.path.isfile(filepath) or os.path.getsize(filepath) != entry["size"]:
+            return False
+        # the checksum is only computed when the size matches, to find a file replaced or corrupted at the same size
+        return file_checksum(filepath) == entry.get("checksum")
+
+    def record(self, accession: str, source: str, filepath: str, last_update_date: str) -> None:
+        """
+        This method records (or updates) the entry of a dataset whose file is in the staging area
+        :param accession: accession number of the dataset
+        :param source: database from which the file was extracted
+        :param filepath: path to the file of the dataset in the staging area
+        :param last_update_date: date of the last update of the file on the external source
+        """
+        self.entries[accession] = {
+            "source": source,
+            "file": os.path.basename(filepath),
+            "size": os.path.getsize(filepath),
+            "checksum": file_checksum(filepath),
+            "last_update_date": last_update_date
+        }
+        self.changed.add(accession)
+
+    def save(self) -> None:
+        """
+        This method writes the entries recorded since the manifest was read into the manifest file. The file is locked
+        and read again first, so that several processes extracting different datasets at the same time (e.g. Luigi
+        workers) do not overwrite each other's entries. The previous file is only replaced when the new one is complete.
+        """
+        with open(self.filename + ".lock", "w") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = self.read()
+            entries.update({accession: self.entries[accession] for accession in self.changed})
+            tmp_filename = self.filename + ".part"
+            with open(tmp_filename, "w", encoding="utf-8") as manifest_file:
+                json.dump(entries, manifest_file, indent=1, sort_keys=True)
+            os.replace(tmp_filename, self.filename)
+        self.entries = entries
+        self.changed = set()
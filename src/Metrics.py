@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the buckets of the latency histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# number of slowest items (files, requests) kept for each histogram
+SLOWEST = 10
+
+
+class Metrics:
+    """
+    This class records the metrics of the pipeline in the current process: counters (e.g. accessions found, files
+    downloaded or skipped, bytes downloaded) and latency histograms (e.g. per request, per file parsed, per Luigi task),
+    which also keep the slowest items observed. The metrics can be saved as JSON, merged with the metrics of other
+    processes and exported in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name: str, labels: dict) -> str:
+        """
+        :param name: name of the metric
+        :param labels: labels of the metric
+        :return: key of the metric with its labels, e.g. 'downloaded_files{source="GEO"}'
+        """
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{label}="{value}"' for label, value in sorted(labels.items())) + "}"
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        """
+        This method adds a value to a counter
+        :param name: name of the counter
+        :param value: value to add
+        :param labels: labels of the counter
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, item: str = None, **labels) -> None:
+        """
+        This method records a duration in a histogram
+        :param name: name of the histogram
+        :param seconds: duration observed
+        :param item: what took that time (file name, URL, ...), kept if it is among the slowest
+        :param labels: labels of the histogram
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(key, {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0,
+                                                         "slowest": []})
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            if item is not None:
+                histogram["slowest"].append([round(seconds, 4), item])
+                histogram["slowest"] = sorted(histogram["slowest"], reverse=True)[:SLOWEST]
+
+    @contextmanager
+    def timer(self, name: str, item: str = None, **labels):
+        """
+        This context manager records the duration of its block in a histogram (see observe)
+        :param name: name of the histogram
+        :param item: what is being timed (file name, URL, ...)
+        :param labels: labels of the histogram
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, item, **labels)
+
+    def snapshot(self) -> dict:
+        """
+        :return: a copy of the metrics recorded
+        """
+        with self.lock:
+            return json.loads(json.dumps({"counters": self.counters, "histograms": self.histograms}))
+
+    def reset(self) -> None:
+        """
+        This method clears the metrics recorded
+        """
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def merge(self, snapshot: dict) -> None:
+        """
+        This method adds the metrics of another process (see snapshot) to these metrics
+        :param snapshot: metrics to add
+        """
+        with self.lock:
+            for key, value in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other in snapshot["histograms"].items():
+                histogram = self.histograms.setdefault(key, {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0,
+                                                             "slowest": []})
+                histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+                histogram["count"] += other["count"]
+                histogram["sum"] += other["sum"]
+                histogram["slowest"] = sorted(histogram["slowest"] + other["slowest"], reverse=True)[:SLOWEST]
+
+    def save(self, filename: str) -> None:
+        """
+        This method writes the metrics recorded as a JSON file
+        :param filename: name of the JSON file
+        """
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename + ".part", "w", encoding="utf-8") as outfile:
+            json.dump(self.snapshot(), outfile, indent=1, sort_keys=True)
+        os.replace(filename + ".part", filename)
+
+    def to_prometheus(self, prefix: str = "iplantsdb_omics_") -> str:
+        """
+        :param prefix: prefix of the names of the metrics
+        :return: the metrics in the Prometheus text exposition format, to be collected by the node exporter textfile
+        collector
+        """
+        lines = []
+        snapshot = self.snapshot()
+        for key, value in sorted(snapshot["counters"].items()):
+            name, _, labels = key.partition("{")
+            if "# TYPE " + prefix + name + "_total counter" not in lines:
+                lines.append("# TYPE " + prefix + name + "_total counter")
+            lines.append(prefix + name + "_total" + ("{" + labels if labels else "") + " " + str(value))
+        for key, histogram in sorted(snapshot["histograms"].items()):
+            name, _, labels = key.partition("{")
+            labels = labels.rstrip("}")
+            if "# TYPE " + prefix + name + " histogram" not in lines:
+                lines.append("# TYPE " + prefix + name + " histogram")
+            separator = "," if labels else ""
+            for bound, count in zip(BUCKETS, histogram["buckets"]):
+                lines.append(prefix + name + '_bucket{' + labels + separator + 'le="' + str(bound) + '"} ' +
+                             str(count))
+            lines.append(prefix + name + '_bucket{' + labels + separator + 'le="+Inf"} ' + str(histogram["count"]))
+            suffix = "{" + labels + "}" if labels else ""
+            lines.append(prefix + name + "_sum" + suffix + " " + str(round(histogram["sum"], 6)))
+            lines.append(prefix + name + "_count" + suffix + " " + str(histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+
+# metrics of the current process, recorded by the Extract, Transform and load modules
+METRICS = Metrics()
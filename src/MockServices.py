@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from MageTabParser import normalize_name, parse_sdrf
+from SoftParser import open_softfile
+
+
+class MockServices:
+    """
+    This class runs local stand-in servers of NCBI (Entrez esearch, GEO family SOFT files and brief views) and
+    BioStudies (ArrayExpress search, study metadata, SDRF and IDF files) in a background thread, serving the files of a
+    staging area, so that the extraction can be run and measured without the remote services. Each request can be
+    delayed (latency and jitter), answered with a server error (503) or a throttling response (429, with Retry-After)
+    at random, and throttled when more than max_rate requests per second are received, as NCBI does.
+
+    The searches only filter the datasets by study type: a GEO series matches the data type of its !Series_type lines,
+    and an ArrayExpress dataset is an RNA-seq study if its SDRF file has library columns, a microarray study otherwise.
+    """
+
+    def __init__(self, staging_path: str = "staging_area/", latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, max_rate: float = None, retry_after: int = 1,
+                 seed: int = 0, port: int = 0):
+        """
+        :param staging_path: staging area folder with the files served
+        :param latency: seconds waited before answering each request
+        :param jitter: maximum random seconds added to the latency
+        :param error_rate: fraction of the requests answered with 503 Service Unavailable
+        :param throttle_rate: fraction of the requests answered with 429 Too Many Requests
+        :param max_rate: maximum number of requests per second; the requests over it are answered with 429 (if None,
+        there is no limit)
+        :param retry_after: seconds sent in the Retry-After header of the 429 responses
+        :param seed: seed of the random delays and failures, so that the same arguments give the same run
+        :param port: port of the servers (0 picks a free port)
+        """
+        self.staging_path = staging_path
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_rate = max_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.port = port
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.stats = {}
+        self.server = None
+        self.thread = None
+        self.geo = {}
+        self.arrayexpress = {}
+
+    def load_fixtures(self) -> None:
+        """
+        This method lists the datasets of the staging area with the study types used by the searches
+        """
+        for file in sorted(os.listdir(self.staging_path)):
+            if file.endswith("_family.soft.gz"):
+                types = []
+                with open_softfile(self.staging_path + file) as f:
+                    for line in f:
+                        if line.startswith("^PLATFORM") or line.startswith("^SAMPLE"):
+                            break
+                        if line.startswith("!Series_type"):
+                            types.append(line.split("=", 1)[1].strip())
+                self.geo[file.split("_")[0]] = types
+            elif file.endswith(".sdrf.txt"):
+                with open(self.staging_path + file, encoding="utf-8", errors="ignore") as f:
+                    header = normalize_name(f.readline())
+                self.arrayexpress[file[:-len(".sdrf.txt")]] = "library" in header
+
+    def start(self) -> dict:
+        """
+        This method starts the servers
+        :return: base URLs of the servers, to replace the ones of the external sources (see Extract.DEFAULT_URLS)
+        """
+        self.load_fixtures()
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), MockHandler)
+        self.server.daemon_threads = True
+        self.server.services = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.urls()
+
+    def stop(self) -> None:
+        """
+        This method stops the servers
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def urls(self) -> dict:
+        """
+        :return: base URLs of the servers, with the same keys as Extract.DEFAULT_URLS
+        """
+        base = "http://127.0.0.1:" + str(self.port) + "/"
+        return {
+            "esearch": base + "entrez/eutils/esearch.fcgi",
+            "geo_ftp": base + "geo/",
+            "geo_query": base + "geo/query/acc.cgi",
+            "biostudies": base + "biostudies/",
+        }
+
+    def fault(self) -> int:
+        """
+        This method delays a request and draws whether it fails
+        :return: HTTP status of the failure (429 or 503), or None if the request is served
+        """
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            draw = self.random.random()
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] > 1:
+                self.recent.popleft()
+            self.recent.append(now)
+            over_rate = self.max_rate is not None and len(self.recent) > self.max_rate
+        if delay > 0:
+            time.sleep(delay)
+        if over_rate or draw < self.throttle_rate:
+            return 429
+        if draw < self.throttle_rate + self.error_rate:
+            return 503
+        return None
+
+    def record(self, endpoint: str, status: int, size: int) -> None:
+        """
+        This method counts a response
+        :param endpoint: name of the endpoint requested
+        :param status: HTTP status of the response
+        :param size: size of the response body in bytes
+        """
+        with self.lock:
+            stats = self.stats.setdefault(endpoint, {"requests": 0, "bytes": 0, "status": {}})
+            stats["requests"] += 1
+            stats["bytes"] += size
+            stats["status"][str(status)] = stats["status"].get(str(status), 0) + 1
+
+    def esearch(self, query: dict) -> bytes:
+        """
+        :param query: parameters of the esearch request (term, retstart, retmax)
+        :return: the XML esearch result, with the GEO series of the data type in the term as GDS UIDs
+        """
+        match = re.search(r"AND (.+) \[DataSet Type\]", query.get("term", [""])[0])
+        data_type = match.group(1) if match else None
+        accessions = [acc for acc, types in self.geo.items() if data_type is None or data_type in types]
+        retstart = int(query.get("retstart", ["0"])[0])
+        retmax = int(query.get("retmax", ["20"])[0])
+        ids = "".join("<Id>" + str(200000000 + int(acc[3:])) + "</Id>"
+                      for acc in accessions[retstart:retstart + retmax])
+        return ('<?xml version="1.0" encoding="UTF-8" ?>\n<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch '
+                '20060628//EN" "https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">\n'
+                '<eSearchResult><Count>' + str(len(accessions)) + '</Count><RetMax>' +
+                str(len(accessions[retstart:retstart + retmax])) + '</RetMax><RetStart>' + str(retstart) +
+                '</RetStart><IdList>' + ids + '</IdList></eSearchResult>').encode("utf-8")
+
+    def brief_soft(self, accession: str) -> bytes:
+        """
+        :param accession: GEO series accession number
+        :return: the brief view of the series: its family SOFT file without the data tables
+        """
+        lines = []
+        in_table = False
+        with open_softfile(self.staging_path + accession + "_family.soft.gz") as f:
+            for line in f:
+                if line.startswith("!") and line.rstrip().endswith("_table_begin"):
+                    in_table = True
+                elif line.startswith("!") and line.rstrip().endswith("_table_end"):
+                    in_table = False
+                elif not in_table:
+                    lines.append(line)
+        return "".join(lines).encode("utf-8")
+
+    def arrayexpress_search(self, query: dict) -> bytes:
+        """
+        :param query: parameters of the search (pageSize, page, study_type)
+        :return: the JSON page of the ArrayExpress datasets of the study type
+        """
+        sequencing = "seq" in query.get("study_type", [""])[0].lower()
+        accessions = [acc for acc, library in self.arrayexpress.items() if library == sequencing]
+        size = int(query.get("pageSize", ["20"])[0])
+        page = int(query.get("page", ["1"])[0])
+        hits = [{"accession": acc} for acc in accessions[(page - 1) * size:page * size]]
+        return json.dumps({"page": page, "pageSize": size, "totalHits": len(accessions), "hits": hits}).encode("utf-8")
+
+    def idf(self, accession: str) -> bytes:
+        """
+        :param accession: ArrayExpress accession number
+        :return: the IDF file of the dataset from the staging area, or one made from its SDRF file if there is none
+        """
+        if os.path.isfile(self.staging_path + accession + ".idf.txt"):
+            with open(self.staging_path + accession + ".idf.txt", "rb") as f:
+                return f.read()
+        study_type = "RNA-seq of coding RNA" if self.arrayexpress[accession] else "transcription profiling by array"
+        return ("Investigation Title\tStudy " + accession + "\nPerson Last Name\tCurator\nPerson First Name\tMock\n"
+                "Experiment Description\tStand-in study " + accession + "\nComment[AEExperimentType]\t" +
+                study_type + "\n").encode("utf-8")
+
+    def study(self, accession: str) -> bytes:
+        """
+        :param accession: ArrayExpress accession number
+        :return: the JSON study metadata of the dataset, as sent by the BioStudies API (only the fields read by
+        Transform.arrayexpress_dictionary)
+        """
+        idf = {}
+        for line in self.idf(accession).decode("utf-8", errors="ignore").splitlines():
+            fields = line.split("\t")
+            idf.setdefault(normalize_name(fields[0]), []).extend(value for value in fields[1:] if value)
+        organisms = parse_sdrf(self.staging_path + accession + ".sdrf.txt")["organisms"]
+        authors = [" ".join(names) for names in zip(idf.get("personfirstname", []), idf.get("personlastname", []))]
+        return json.dumps({
+            "accno": accession,
+            "attributes": [{"name": "Title", "value": " ".join(idf.get("investigationtitle", []))},
+                           {"name": "ReleaseDate", "value": ""}, {"name": "RootPath", "value": accession},
+                           {"name": "AttachTo", "value": "ArrayExpress"}],
+            "section": {
+                "attributes": [{"name": "Title", "value": " ".join(idf.get("investigationtitle", []))},
+                               {"name": "Study type", "value": " , ".join(idf.get("comment[aeexperimenttype]", []))},
+                               {"name": "Organism", "value": ", ".join(organisms)},
+                               {"name": "Description", "value": " ".join(idf.get("experimentdescription", []))}],
+                "subsections": [{"type": "Author", "attributes": [{"name": "Name", "value": author}]}
+                                for author in authors]
+            }
+        }).encode("utf-8")
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    This class answers the requests to the stand-in servers of MockServices
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        # the requests are counted in MockServices.stats instead of logged
+        pass
+
+    def do_HEAD(self) -> None:
+        self.answer(body=False)
+
+    def do_GET(self) -> None:
+        self.answer(body=True)
+
+    def route(self, path: str, query: dict) -> tuple:
+        """
+        :param path: path of the request
+        :param query: parameters of the request
+        :return: tuple with the name of the endpoint, the content type and a function without arguments that returns
+        the response body (or None to send the file) and the path of the file served or the response is made from
+        (whose modification time is sent as Last-Modified; None for the searches), or None if nothing is served at that
+        path
+        """
+        services = self.server.services
+        staging = services.staging_path
+        if path == "/entrez/eutils/esearch.fcgi":
+            return "esearch", "text/xml", lambda: (services.esearch(query), None)
+        match = re.fullmatch(r"/geo/series/\w+/(GSE\d+)/soft/(GSE\d+_family\.soft\.gz)", path)
+        if match and match.group(1) in services.geo:
+            return "geo_soft", "application/x-gzip", lambda: (None, staging + match.group(2))
+        if path == "/geo/query/acc.cgi" and query.get("acc", [""])[0] in services.geo:
+            accession = query["acc"][0]
+            return "geo_brief", "text/plain", lambda: (services.brief_soft(accession),
+                                                       staging + accession + "_family.soft.gz")
+        if path == "/biostudies/api/v1/arrayexpress/search":
+            return "biostudies_search", "application/json", lambda: (services.arrayexpress_search(query), None)
+        match = re.fullmatch(r"/biostudies/api/v1/studies/([\w-]+)", path)
+        if match and match.group(1) in services.arrayexpress:
+            return "biostudies_study", "application/json", lambda: (services.study(match.group(1)),
+                                                                    staging + match.group(1) + ".sdrf.txt")
+        match = re.fullmatch(r"/biostudies/files/([\w-]+)/([\w-]+)\.(sdrf|idf)\.txt", path)
+        if match and match.group(1) in services.arrayexpress:
+            if match.group(3) == "sdrf":
+                return "sdrf", "text/plain", lambda: (None, staging + match.group(1) + ".sdrf.txt")
+            # the IDF file made from the SDRF file when there is none has the date of the SDRF file
+            return "idf", "text/plain", lambda: (services.idf(match.group(1)), staging + match.group(1) + ".sdrf.txt")
+        return None
+
+    def answer(self, body: bool) -> None:
+        """
+        This method sends the response of a request, or a failure drawn by MockServices.fault
+        :param body: False for a HEAD request (headers only)
+        """
+        services = self.server.services
+        url = urlparse(self.path)
+        route = self.route(url.path, parse_qs(url.query))
+        endpoint = route[0] if route is not None else "unknown"
+
+        status = services.fault()
+        if status is None and route is None:
+            status = 404
+        if status is not None:
+            content = json.dumps({"status": status}).encode("utf-8")
+            self.send_response(status)
+            if status == 429:
+                self.send_header("Retry-After", str(services.retry_after))
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            if body:
+                self.wfile.write(content)
+            services.record(endpoint, status, len(content) if body else 0)
+            return
+
+        endpoint, content_type, produce = route
+        content, filepath = produce()
+        if content is None:
+            with open(filepath, "rb") as f:
+                content = f.read()
+        modified = os.path.getmtime(filepath) if filepath is not None else time.time()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Last-Modified", formatdate(modified, usegmt=True))
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+        services.record(endpoint, 200, len(content) if body else 0)
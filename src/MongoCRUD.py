@@ -1,18 +1,168 @@
 # Import required modules
 import Mongo_schema_Load
-from Mongo_schema_Load import Transcriptomics
+from Config import connect_mongodb
+from Metrics import METRICS
 from mongoengine import *
 
+# fields of a dataset summary: all the fields except the samples, which can be very large
+SUMMARY_FIELDS = ("database", "title", "data_type", "organism", "platform_id", "contributors", "last_update_date",
+                  "overall_design", "sample_count")
 
-def update_mongo(new_data):
+
+def update_mongo(new_data, batch_size: int = 500, separate_samples: bool = False) -> dict:
     """"
-    This method performs the target database update if a new accession number is added
+    This method performs the target database update: the new accession numbers are inserted, the changed datasets are
+    replaced and the unchanged ones are skipped
+    :param new_data: dataset's data from the JSON file (dictionary), or an iterable of datasets such as the generator of
+    Mongo_schema_Load.read_ndjson_database
+    :param batch_size: number of datasets sent to the target database in each bulk write
+    :param separate_samples: if True, store the samples in the TranscriptomicsSample collection instead of embedding
+    them in the datasets (see Mongo_schema_Load.bulk_upsert)
+    :return: dictionary with the number of inserted, updated and unchanged datasets
+    """
+    if isinstance(new_data, dict):
+        new_data = new_data.values()
+    with METRICS.timer("update_mongo_seconds"):
+        counts = Mongo_schema_Load.bulk_upsert(new_data, batch_size, separate_samples)
+    print("NEW ENTRIES INSERTED: " + str(counts["inserted"]) + ", UPDATED: " + str(counts["updated"]) +
+          ", UNCHANGED: " + str(counts["unchanged"]))
+    return counts
+
+
+def dataset_filter(organism: str = None, data_type: str = None, platform_id: str = None, database: str = None,
+                   updated_since=None, text: str = None) -> dict:
+    """
+    This method builds the query of the datasets that match all the given conditions, on indexed fields (see
+    Mongo_schema_Load.Transcriptomics)
+    :param organism: organism of the datasets
+    :param data_type: data type of the datasets
+    :param platform_id: platform used by the datasets
+    :param database: source database of the datasets (GEO or ArrayExpress)
+    :param updated_since: datetime from which the datasets were last updated
+    :param text: words searched in the title and overall design of the datasets (text index)
+    :return: the MongoDB query
+    """
+    query = {}
+    for field, value in (("organism", organism), ("data_type", data_type), ("platform_id", platform_id),
+                         ("database", database)):
+        if value is not None:
+            query[field] = value
+    if updated_since is not None:
+        query["last_update_date"] = {"$gte": updated_since}
+    if text is not None:
+        query["$text"] = {"$search": text}
+    return query
+
+
+def projection(fields: tuple = SUMMARY_FIELDS) -> dict:
+    """
+    :param fields: fields of the datasets to read, or None to read all of them
+    :return: the MongoDB projection of the fields (the content hash used by the updates is never read)
+    """
+    if fields is None:
+        return {"content_hash": 0}
+    return {field: 1 for field in fields}
+
+
+def from_mongo(doc: dict) -> dict:
+    """
+    :param doc: document read from the target database
+    :return: the dataset, with its accession number under the same name as in the JSON file
+    """
+    doc["accession_number"] = doc.pop("_id")
+    return doc
+
+
+def find_datasets(fields: tuple = SUMMARY_FIELDS, batch_size: int = 500, **filters):
+    """
+    This method reads the datasets that match the filters, in the order of their accession numbers. Only the given
+    fields are sent by the target database (the summary by default), and the cursor receives them in batches, so
+    the whole collection is never held in memory.
+    :param fields: fields of the datasets to read, or None to read all of them, samples included
+    :param batch_size: number of datasets received from the target database in each batch
+    :param filters: conditions of the datasets (organism, data_type, platform_id, database, updated_since, text; see
+    dataset_filter)
+    :return: generator of the datasets
+    """
+    connect_mongodb()
+    collection = Mongo_schema_Load.Transcriptomics._get_collection()
+    cursor = collection.find(dataset_filter(**filters), projection(fields)).sort("_id", 1).batch_size(batch_size)
+    for doc in cursor:
+        yield from_mongo(doc)
+
+
+def page_datasets(after: str = None, limit: int = 100, fields: tuple = SUMMARY_FIELDS, **filters) -> tuple:
+    """
+    This method reads one page of the datasets that match the filters. The pages are ordered by accession number and
+    each one starts after the last accession number of the previous page, so reading a page does not skip over the
+    previous ones on the server.
+    :param after: last accession number of the previous page, or None for the first page
+    :param limit: maximum number of datasets of the page
+    :param fields: fields of the datasets to read, or None to read all of them
+    :param filters: conditions of the datasets (see dataset_filter)
+    :return: tuple with the list of datasets of the page and the accession number to request the next page (None if
+    this is the last page)
+    """
+    connect_mongodb()
+    collection = Mongo_schema_Load.Transcriptomics._get_collection()
+    query = dataset_filter(**filters)
+    if after is not None:
+        query["_id"] = {"$gt": after}
+    datasets = [from_mongo(doc) for doc in collection.find(query, projection(fields)).sort("_id", 1).limit(limit)]
+    if len(datasets) < limit:
+        return datasets, None
+    return datasets, datasets[-1]["accession_number"]
+
+
+def get_dataset(accession: str, fields: tuple = None) -> dict:
+    """
+    :param accession: accession number of the dataset
+    :param fields: fields of the dataset to read, or None to read all of them
+    :return: the dataset, or None if it is not in the target database
+    """
+    connect_mongodb()
+    doc = Mongo_schema_Load.Transcriptomics._get_collection().find_one({"_id": accession}, projection(fields))
+    return from_mongo(doc) if doc is not None else None
+
+
+def find_samples(accession: str, batch_size: int = 1000):
+    """
+    This method reads the samples of a dataset stored in the TranscriptomicsSample collection (through its index on
+    the dataset accession number)
+    :param accession: accession number of the dataset
+    :param batch_size: number of samples received from the target database in each batch
+    :return: generator of (sample ID, description) tuples
+    """
+    connect_mongodb()
+    collection = Mongo_schema_Load.TranscriptomicsSample._get_collection()
+    cursor = collection.find({"dataset": accession}, {"_id": 0, "sample_id": 1, "description": 1})
+    for doc in cursor.sort("sample_id", 1).batch_size(batch_size):
+        yield doc["sample_id"], doc.get("description", "")
+
+
+def get_samples(accession: str) -> dict:
+    """
+    :param accession: accession number of the dataset
+    :return: dictionary with the description of each sample of the dataset, whether the samples are embedded in the
+    dataset or stored in the TranscriptomicsSample collection
+    """
+    dataset = get_dataset(accession, ("samples", "sample_ids"))
+    if dataset is None:
+        return {}
+    if dataset.get("samples") or not dataset.get("sample_ids"):
+        return dataset.get("samples", {})
+    samples = dict(find_samples(accession))
+    # in the order of the dataset
+    return {sample_id: samples.get(sample_id, "") for sample_id in dataset["sample_ids"]}
+
+
+def count_datasets(**filters) -> int:
+    """
+    :param filters: conditions of the datasets (see dataset_filter)
+    :return: number of datasets that match the filters
     """
-    for key, value in new_data.items():
-        new_doc = Transcriptomics(**value)
-        if DoesNotExist:  # when a new entry is added
-            print("NEW ENTRY INSERTED")
-            new_doc.save()
+    connect_mongodb()
+    return Mongo_schema_Load.Transcriptomics._get_collection().count_documents(dataset_filter(**filters))
 
 
 if __name__ == "__main__":
@@ -20,6 +170,6 @@ if __name__ == "__main__":
     connect(host="mongodb://palsson.di.uminho.pt:1017/plantcyc")
 
     data = Mongo_schema_Load
-    db_file = "data/dataset.json"
-    transcript_data = data.read_json_database(filename=db_file)
+    db_file = "data/dataset.ndjson"
+    transcript_data = data.read_ndjson_database(filename=db_file)
     update_mongo(transcript_data)
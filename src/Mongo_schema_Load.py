@@ -1,24 +1,14 @@
 # Import required modules
+import hashlib
 import json
+from itertools import islice
+from pymongo import ReplaceOne
 from mongoengine import *
 from datetime import datetime
+from Config import connect_mongodb
+from Metrics import METRICS
 
-from configparser import RawConfigParser
-
-db_configs = RawConfigParser()
-db_configs.read('/iplantsdb_omics/conf/iplantsdb_omics.conf')
-
-# Connects to target database by authenticating
-
-MONGODB_DATABASE = {
-    "name": str(db_configs.get('iplants-omics-configurations', 'mongodb_name')),
-    "host": str(db_configs.get('iplants-omics-configurations', 'mongodb_host')),
-    "port": int(db_configs.get('iplants-omics-configurations', 'mongodb_port')),
-}
-
-disconnect()
-connect(MONGODB_DATABASE["name"], host=MONGODB_DATABASE["host"],
-        port=MONGODB_DATABASE["port"])
+# The connection to the target database is only opened when it is first used (see Config.connect_mongodb)
 
 
 class Transcriptomics(Document):
@@ -37,6 +27,42 @@ class Transcriptomics(Document):
     last_update_date = DateTimeField(required=True, default=datetime.utcnow)
     overall_design = StringField()
     samples = DictField()
+    # with the samples in the TranscriptomicsSample collection, the dataset only keeps their number and IDs
+    sample_count = IntField()
+    sample_ids = ListField(StringField())
+    content_hash = StringField()
+
+    # indexes of the fields used to filter the datasets (see MongoCRUD.find_datasets) and text index of the title and
+    # overall design, created with the collection
+    meta = {
+        "indexes": [
+            "organism",
+            "data_type",
+            "platform_id",
+            "database",
+            "-last_update_date",
+            {"fields": ["$title", "$overall_design"], "default_language": "english",
+             "weights": {"title": 2, "overall_design": 1}},
+        ]
+    }
+
+
+class TranscriptomicsSample(Document):
+    """
+    This class defines the documents of the samples of the datasets, when they are stored apart from the datasets (see
+    bulk_upsert), so that a dataset with many samples stays small and its samples are read by the accession number of
+    the dataset through an index.
+    """
+
+    dataset = StringField(required=True)
+    sample_id = StringField(required=True)
+    description = StringField()
+
+    meta = {
+        "indexes": [
+            {"fields": ["dataset", "sample_id"], "unique": True},
+        ]
+    }
 
 
 def read_json_database(filename: str):
@@ -45,25 +71,132 @@ def read_json_database(filename: str):
     :param filename: name of the json file which contains the datasets and returns its data
     """
 
-    with open(filename, encoding="mbcs") as json_file:
+    with open(filename, encoding="utf-8") as json_file:
         data = json.load(json_file)
         return data
 
 
-def load_data(data_dic: dict) -> None:
+def read_ndjson_database(filename: str):
+    """
+    This function reads a newline-delimited JSON catalog obtained from the Transform class one dataset at a time, so
+    the memory used does not grow with the size of the catalog
+    :param filename: name of the catalog file, with one dataset per line
+    :return: generator of the datasets
+    """
+
+    with open(filename, encoding="utf-8") as catalog:
+        for line in catalog:
+            if line.strip():
+                yield json.loads(line)
+
+
+def content_hash(value: dict) -> str:
+    """
+    This function computes a hash of a dataset, used to detect the datasets that did not change since the last load
+    :param value: dataset's data from the JSON file
+    :return: hexadecimal SHA-256 hash of the dataset
+    """
+    content = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def replace_documents(collection, documents: list) -> int:
+    """
+    This function inserts or replaces documents by their _id in one unordered bulk write. With an in-memory mongomock
+    client (tests and Benchmark.py --mongo mongomock) they are replaced one by one instead, since mongomock does not
+    accept the options that recent pymongo versions send with the operations of a bulk write.
+    :param collection: pymongo (or mongomock) collection
+    :param documents: documents to write, each one with its _id
+    :return: number of documents inserted (the others replaced an existing document)
+    """
+    if type(collection).__module__.startswith("mongomock"):
+        return sum(collection.replace_one({"_id": doc["_id"]}, doc, upsert=True).upserted_id is not None
+                   for doc in documents)
+    result = collection.bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in documents],
+                                   ordered=False)
+    return result.upserted_count
+
+
+def bulk_upsert(datasets, batch_size: int = 500, separate_samples: bool = False) -> dict:
+    """
+    This function inserts the new datasets and replaces the changed ones in the target database, sending them in
+    batches of unordered bulk writes keyed on the accession number instead of one request per dataset. The datasets
+    whose content hash is the same as the stored one are not sent.
+    :param datasets: iterable of datasets, e.g. the values of the JSON file or the generator of read_ndjson_database
+    :param batch_size: number of datasets sent in each bulk write
+    :param separate_samples: if True, the samples are inserted in the TranscriptomicsSample collection, in batches,
+    and the datasets only keep the number and IDs of their samples; otherwise the samples are embedded in the datasets
+    :return: dictionary with the number of inserted, updated and unchanged datasets
+    """
+    connect_mongodb()
+    collection = Transcriptomics._get_collection()
+    samples_collection = TranscriptomicsSample._get_collection()
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    datasets = iter(datasets)
+
+    while True:
+        batch = list(islice(datasets, batch_size))
+        if not batch:
+            break
+        ids = [value["accession_number"] for value in batch]
+        with METRICS.timer("mongo_seconds", operation="find_hashes"):
+            stored = {doc["_id"]: doc.get("content_hash")
+                      for doc in collection.find({"_id": {"$in": ids}}, {"content_hash": 1})}
+
+        documents = []
+        changed = []
+        samples = []
+        for value in batch:
+            value_hash = content_hash(value)
+            if separate_samples:
+                # the layout is part of the hash, so the datasets loaded in the other layout are loaded again
+                value_hash = content_hash({"separate_samples": value_hash})
+            if stored.get(value["accession_number"]) == value_hash:
+                counts["unchanged"] += 1
+                continue
+            if separate_samples:
+                doc = Transcriptomics(**dict(value, samples={}), sample_count=len(value["samples"]),
+                                      sample_ids=list(value["samples"]), content_hash=value_hash)
+                samples += [{"dataset": value["accession_number"], "sample_id": sample_id, "description": description}
+                            for sample_id, description in value["samples"].items()]
+            else:
+                doc = Transcriptomics(**value, content_hash=value_hash)
+            doc.validate()
+            documents.append(doc.to_mongo())
+            changed.append(doc.pk)
+
+        if documents:
+            with METRICS.timer("mongo_seconds", operation="bulk_write"):
+                upserted = replace_documents(collection, documents)
+            counts["inserted"] += upserted
+            counts["updated"] += len(documents) - upserted
+
+            # the samples of the changed datasets are replaced (and removed if they are now embedded)
+            with METRICS.timer("mongo_seconds", operation="samples_write"):
+                samples_collection.delete_many({"dataset": {"$in": changed}})
+                for i in range(0, len(samples), batch_size):
+                    samples_collection.insert_many(samples[i:i + batch_size], ordered=False)
+
+    for name, count in counts.items():
+        METRICS.increment("datasets_loaded", count, result=name)
+    return counts
+
+
+def load_data(data_dic: dict, batch_size: int = 500, separate_samples: bool = False) -> dict:
     """
     :param data_dic: dataset's data from the JSON file
+    :param batch_size: number of datasets sent to the target database in each bulk write
+    :param separate_samples: if True, store the samples in the TranscriptomicsSample collection (see bulk_upsert)
+    :return: dictionary with the number of inserted, updated and unchanged datasets
     """
 
-    for key, value in data_dic.items():
-        doc = Transcriptomics(**value)
-        doc.save()
+    return bulk_upsert(data_dic.values(), batch_size, separate_samples)
 
 
 if __name__ == "__main__":
     data = Transcriptomics()
     # data.drop_collection()
 
-    db_file = "data/dataset.json"
-    transcript_data = read_json_database(filename=db_file)
-    load_data(data_dic=transcript_data)
+    db_file = "data/dataset.ndjson"
+    transcript_data = read_ndjson_database(filename=db_file)
+    bulk_upsert(transcript_data)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+from Metrics import METRICS
+
+# time to live (seconds) of the cached responses of each endpoint
+DAY = 24 * 60 * 60
+DEFAULT_TTLS = {
+    "esearch": DAY,  # NCBI Entrez searches
+    "biostudies_search": DAY,  # ArrayExpress searches on BioStudies
+    "biostudies_study": 30 * DAY,  # BioStudies study metadata, which almost never changes
+}
+
+
+class OfflineCacheMiss(Exception):
+    """
+    Raised in offline mode when a response is not in the cache
+    """
+
+
+class ResponseCache:
+    """
+    This class keeps the responses of the remote APIs (NCBI Entrez and BioStudies) in a SQLite file, so that repeated
+    runs do not request them again. Each response is keyed by the request URL and parameters, expires after the time
+    to live of its endpoint, and the least recently used responses are evicted when the cache grows over max_bytes.
+    In offline mode only the cached responses are used, whatever their age.
+    """
+
+    def __init__(self, path: str = "cache/responses.sqlite", ttls: dict = None, max_bytes: int = 500 * 1024 * 1024,
+                 offline: bool = False):
+        """
+        :param path: path to the SQLite file of the cache
+        :param ttls: time to live (seconds) of the responses of each endpoint, updating DEFAULT_TTLS
+        :param max_bytes: maximum size of the cached responses
+        :param offline: if True, never send requests and only serve responses from the cache
+        """
+        self.path = path
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # the SQLite connection is not sent to other processes, each one opens its own
+        state = self.__dict__.copy()
+        state["connection"] = None
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        :return: the connection to the SQLite file of the current process, created on first use
+        """
+        if self.connection is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, endpoint TEXT, "
+                                    "url TEXT, body BLOB, size INTEGER, stored REAL, accessed REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self.connection.commit()
+            self.pid = os.getpid()
+        return self.connection
+
+    @staticmethod
+    def key(url: str, params: dict = None) -> str:
+        """
+        :param url: URL of the request
+        :param params: parameters of the request
+        :return: key of the request in the cache
+        """
+        request = json.dumps([url, params or {}], sort_keys=True, default=str)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def fetch(self, endpoint: str, url: str, params: dict = None, request=None) -> bytes:
+        """
+        This method returns the response of a request from the cache, or sends the request and caches its response
+        :param endpoint: name of the endpoint, which sets the time to live of the response (see DEFAULT_TTLS)
+        :param url: URL of the request
+        :param params: parameters of the request
+        :param request: function without arguments that sends the request and returns the response body (bytes);
+        defaults to a GET of url with params
+        :return: the response body
+        """
+        key = self.key(url, params)
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            row = connection.execute("SELECT body, stored FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and (self.offline or now - row[1] < self.ttls.get(endpoint, DAY)):
+                connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                connection.commit()
+                self.hits += 1
+                METRICS.increment("cache_hits", endpoint=endpoint)
+                return row[0]
+            self.misses += 1
+            METRICS.increment("cache_misses", endpoint=endpoint)
+
+        if self.offline:
+            raise OfflineCacheMiss(url + " is not in the cache")
+        if request is None:
+            def request():
+                response = requests.get(url, params=params, timeout=60)
+                response.raise_for_status()
+                return response.content
+        body = request()
+
+        with self.lock:
+            connection = self.connect()
+            connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (key, endpoint, url, body, len(body), now, now))
+            self.evict()
+            connection.commit()
+        return body
+
+    def get_json(self, endpoint: str, url: str, params: dict = None) -> dict:
+        """
+        This method returns the JSON response of a GET request, from the cache if possible (see fetch)
+        :param endpoint: name of the endpoint, which sets the time to live of the response
+        :param url: URL of the request
+        :param params: parameters of the request
+        :return: the decoded JSON response
+        """
+        return json.loads(self.fetch(endpoint, url, params))
+
+    def evict(self) -> None:
+        """
+        This method deletes the least recently used responses until the cache is not larger than max_bytes
+        """
+        connection = self.connect()
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self) -> dict:
+        """
+        :return: dictionary with the number of hits and misses of this cache object, and the number and total size of
+        the cached responses
+        """
+        with self.lock:
+            count, size = self.connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "responses": count, "bytes": size}
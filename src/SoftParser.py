@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import gzip
+import re
+from collections import defaultdict
+
+# version of the parser, to be increased when its results change (the transformed datasets cached are then discarded)
+PARSER_VERSION = 1
+
+# prefix of a metadata line, e.g. "!Series_", "!Platform_" or "!Sample_"
+ENTRY_PREFIX = re.compile(r"!\w*?_")
+
+
+def open_softfile(filepath: str):
+    """
+    This function opens a SOFT file in text mode, decompressing it on the fly when it is gzipped
+    :param filepath: path to the SOFT file (.soft or .soft.gz)
+    :return: a file handle that yields the lines of the SOFT file
+    """
+    if filepath.endswith(".gz"):
+        return gzip.open(filepath, "rt", encoding="utf-8", errors="ignore")
+    return open(filepath, "r", encoding="utf-8", errors="ignore")
+
+
+def parse_entry(line: str) -> tuple:
+    """
+    This function parses a SOFT line that starts with '^' or '!' into a key/value pair, using the same key names as
+    GEOparse (e.g. "!Series_title = x" gives ("title", "x"))
+    :param line: line of the SOFT file
+    :return: tuple with the entry key and its value
+    """
+    if line.startswith("!"):
+        line = ENTRY_PREFIX.sub("", line, count=1)
+    else:
+        line = line.strip()[1:]
+    key, _, value = line.partition("=")
+    return key.strip(), value.strip()
+
+
+def parse_soft_metadata(filepath: str) -> dict:
+    """
+    This function reads a GSE family SOFT file line by line and keeps only the metadata ("!") lines of the series,
+    platforms and samples. The data tables between "!..._table_begin" and "!..._table_end" are skipped without being
+    stored, so the memory used does not depend on the size of the probe or expression tables.
+    :param filepath: path to the GSE family SOFT file (.soft or .soft.gz)
+    :return: dictionary with the series metadata ("metadata"), and the metadata of each platform ("gpls") and
+    sample ("gsms"), in file order and keyed by their accession numbers
+    """
+    soft = {"metadata": {}, "gpls": {}, "gsms": {}}
+    sections = {"SERIES": None, "PLATFORM": soft["gpls"], "SAMPLE": soft["gsms"]}
+    current = None
+    in_table = False
+
+    with open_softfile(filepath) as handle:
+        for line in handle:
+            if in_table:
+                if line.startswith("!") and "_table_end" in line:
+                    in_table = False
+                continue
+
+            if line.startswith("^"):
+                entry_type, entry_name = parse_entry(line)
+                current = defaultdict(list)
+                if entry_type == "SERIES":
+                    soft["metadata"] = current
+                elif sections.get(entry_type) is not None:
+                    sections[entry_type][entry_name] = current
+                continue
+
+            if current is None or not line.startswith("!"):
+                continue
+
+            if "_table_begin" in line or "_table_end" in line:
+                in_table = "_table_begin" in line
+                continue
+
+            key, value = parse_entry(line.rstrip())
+            current[key].append(value)
+
+    soft["metadata"] = dict(soft["metadata"])
+    soft["gpls"] = {name: dict(meta) for name, meta in soft["gpls"].items()}
+    soft["gsms"] = {name: dict(meta) for name, meta in soft["gsms"].items()}
+    return soft
@@ -1,12 +1,25 @@
 # -*- coding: utf-8 -*-
 
 # importing required modules
-from os.path import isfile, join
-import GEOparse
-from os import listdir
+import argparse
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from os.path import basename, dirname, isfile, join
+from os import listdir, makedirs
 import json
-import requests
-from Extract import Extract
+from Catalog import Catalog
+from Extract import DEFAULT_URLS, Extract
+from ResponseCache import ResponseCache
+import MageTabParser
+from MageTabParser import parse_idf, parse_sdrf
+from Metrics import METRICS
+import SoftParser
+from SoftParser import parse_soft_metadata
+from TransformCache import TransformCache
+
+# version of the transform of the datasets, to be increased when geo_dictionary or arrayexpress_dictionary change their
+# results (the transformed datasets cached are then discarded)
+TRANSFORM_VERSION = 1
 
 
 class Transform:
@@ -14,11 +27,26 @@ class Transform:
     This class transforms the data from the staging area (obtain from the Extract class) into a specific format
     """
 
-    def __init__(self) -> None:
+    def __init__(self, cache: ResponseCache = None, transform_cache: TransformCache = None,
+                 urls: dict = None) -> None:
+        """
+        :param cache: cache of the responses of the BioStudies API (defaults to a ResponseCache with the default
+        settings)
+        :param transform_cache: cache of the transformed datasets, so that the unchanged files of the staging area are
+        not parsed again (if None, every file is parsed)
+        :param urls: base URLs of the external sources, updating Extract.DEFAULT_URLS
+        """
         self.dictionaryPrincipal = {}
         self.index = 0
 
         self.file_path = "staging_area/"
+        self.cache = cache if cache is not None else ResponseCache()
+        self.transform_cache = transform_cache
+        self.urls = dict(DEFAULT_URLS, **(urls or {}))
+
+        # newline-delimited JSON catalog where the datasets are written as they are transformed (see open_catalog)
+        self.catalog = None
+        self.done = set()
 
     def open_files(self, file_type) -> list:
         """
@@ -29,7 +57,20 @@ class Transform:
         allfiles = [f for f in listdir(self.file_path) if isfile(join(self.file_path, f)) and file_type in f]
         return allfiles
 
-    def createFile(self) -> None:
+    def softfiles(self) -> list:
+        """
+        This method lists the SOFT files of the GEO datasets in the staging area, one per dataset: the family SOFT file
+        or, if there is none, the brief SOFT file with the metadata only (see Extract.brief_url)
+        :return: list of the names of the SOFT files
+        """
+        files = {}
+        for file in self.open_files(".soft.gz"):
+            accession = file.split("_")[0]
+            if accession not in files or file.endswith("_family.soft.gz"):
+                files[accession] = file
+        return list(files.values())
+
+    def createFile(self, filename: str = "data/dataset.json") -> None:
         """
         This method creates a JSON file containing the datasets from the GEO and ArrayExpress. For each dataset, the
         information retrieved is organized into a dictionary and includes:
@@ -43,98 +84,266 @@ class Transform:
         - last_update_date: date of the last update
         - overall design: descriptive information about the samples and the overall study
         - samples: dictionary where the keys are samples id's and the values corresponds to the samples descriptions
+        :param filename: name of the JSON file
         """
-        with open("data/dataset.json", "w", encoding="utf-8") as outfile:
+        with open(filename, "w", encoding="utf-8") as outfile:
             json.dump(self.dictionaryPrincipal, outfile, ensure_ascii=False)
 
-    def transformGEO(self) -> None:
+    def createSQLiteCatalog(self, filename: str = "data/catalog.sqlite", datasets=None) -> dict:
         """
-        This method transforms the GEO's datasets extracted.
+        This method writes the datasets to the local SQLite catalog (see Catalog), with the same fields as createFile.
+        The datasets already in the catalog are only written again if they changed.
+        :param filename: name of the SQLite file of the catalog
+        :param datasets: iterable of transformed datasets, e.g. the lines of the newline-delimited JSON catalog (if
+        None, the datasets of dictionaryPrincipal)
+        :return: dictionary with the number of inserted, updated and unchanged datasets
+        """
+        catalog = Catalog(filename)
+        counts = catalog.upsert(self.dictionaryPrincipal.values() if datasets is None else datasets)
+        catalog.close()
+        return counts
+
+    def open_catalog(self, filename: str = "data/dataset.ndjson", resume: bool = False) -> None:
+        """
+        This method opens a newline-delimited JSON catalog: from then on, each dataset is written to it as one line
+        (with the same fields as in createFile) as soon as it is transformed, instead of being kept in memory
+        :param filename: name of the catalog file
+        :param resume: if True, the datasets already in the catalog (of an interrupted run) are kept and not transformed
+        again; otherwise the catalog is started from scratch
+        """
+        self.done = set()
+        makedirs(dirname(filename) or ".", exist_ok=True)
+        if resume and isfile(filename):
+            with open(filename, "r+", encoding="utf-8") as catalog:
+                end = 0
+                for line in iter(catalog.readline, ""):
+                    if not line.endswith("\n"):  # dataset partially written when the run was interrupted
+                        break
+                    self.done.add(json.loads(line)["accession_number"])
+                    end = catalog.tell()
+                catalog.truncate(end)
+        self.catalog = open(filename, "a" if resume else "w", encoding="utf-8")
+
+    def close_catalog(self) -> None:
+        """
+        This method closes the newline-delimited JSON catalog
+        """
+        if self.catalog is not None:
+            self.catalog.close()
+            self.catalog = None
+
+    def add_dataset(self, dictionaryTemp: dict) -> None:
+        """
+        This method adds a transformed dataset to the catalog, if one is open, or to dictionaryPrincipal
+        :param dictionaryTemp: dictionary with the transformed dataset
+        """
+        if self.catalog is not None:
+            self.catalog.write(json.dumps(dictionaryTemp, ensure_ascii=False) + "\n")
+            self.catalog.flush()
+            self.done.add(dictionaryTemp["accession_number"])
+        else:
+            x = "dataset" + str(self.index + 1)
+            self.dictionaryPrincipal[x] = dictionaryTemp
+
+        self.index += 1
+        METRICS.increment("datasets_transformed", database=dictionaryTemp["database"])
+
+    def read_softfile(self, filepath: str, parser: str = "stream") -> dict:
+        """
+        This method reads the metadata of a GSE family SOFT file
+        :param filepath: path to the SOFT file
+        :param parser: "stream" reads only the metadata lines of the file (default), "geoparse" builds the full
+        GEOparse object, including the platform and sample data tables
+        :return: dictionary with the series metadata ("metadata") and the metadata of each platform ("gpls") and
+        sample ("gsms")
+        """
+        if parser == "stream":
+            return parse_soft_metadata(filepath)
+        if parser == "geoparse":
+            # GEOparse (and pandas) are only imported when this parser is used
+            import GEOparse
+            gse = GEOparse.get_GEO(filepath=filepath)
+            return {"metadata": gse.metadata,
+                    "gpls": {gpl_name: gpl.metadata for gpl_name, gpl in gse.gpls.items()},
+                    "gsms": {gsm_name: gsm.metadata for gsm_name, gsm in gse.gsms.items()}}
+        raise ValueError("Unknown SOFT parser: " + parser)
+
+    def geo_dictionary(self, filepath: str, parser: str = "stream") -> dict:
+        """
+        This method transforms one GEO's dataset extracted.
+        :param filepath: path to the SOFT file of the dataset
+        :param parser: SOFT parser to use, "stream" or "geoparse" (see read_softfile)
+        :return: dictionary with the transformed dataset
         """
 
         # There are 3 main components of each GSE (Series) object: a dictionary of GSM (Samples) objects,
         # a dictionary of GPL (Platforms) objects and its own metadata
-        for file in self.open_files(".soft.gz"):
+        with METRICS.timer("parse_seconds", filepath, source="GEO", parser=parser):
+            soft = self.read_softfile(filepath, parser)
+        metadata = soft["metadata"]
+        dictionaryTemp = {
+            "database": "",
+            "title": "",
+            "data_type": "",
+            "organism": "",
+            "accession_number": "",
+            "platform_id": [],
+            "contributors": [],
+            "last_update_date": "",
+            "overall_design": "",
+            "samples": {}
+        }
+
+        # GSE (Series) is an original submitter-supplied record that summarizes the study, including samples and
+        # platforms
+        if "GSE" in metadata["geo_accession"][0]:
+            dictionaryTemp["database"] = "GEO"
+
+        dictionaryTemp["title"] = metadata["title"][0]
+        dictionaryTemp["data_type"] = " , ".join(metadata["type"])
+
+        # GPL (Platform) contains a tab-delimited table containing the array definition
+        for gpl_name, gpl in soft["gpls"].items():
+            dictionaryTemp["organism"] = gpl["organism"][0]
+
+        dictionaryTemp["accession_number"] = metadata["geo_accession"][0]
+        dictionaryTemp["platform_id"] = metadata["platform_id"]
+
+        if "contributor" in metadata:
+            dictionaryTemp["contributors"] = metadata["contributor"]
+
+        strDate = metadata["last_update_date"][0]
+        dictionaryTemp["last_update_date"] = strDate
+
+        dictionaryTemp["overall_design"] = metadata["overall_design"][0]
+
+        # GSM (Sample) contains information about the conditions and preparation of a sample
+        lista = []
+        for gsm_name, gsm in soft["gsms"].items():
+            if "description" in gsm:
+                lista.append(" ".join(gsm["description"]))
+            else:
+                lista.append("")
+
+        # each sample ID is paired with the description in the same position
+        dictionaryTemp["samples"] = dict(zip(metadata["sample_id"], lista))
+
+        return dictionaryTemp
+
+    def transform_dataset(self, source: str, name: str, parser: str = "stream") -> dict:
+        """
+        This method transforms one dataset (see geo_dictionary and arrayexpress_dictionary). With a transform cache, the
+        dataset is taken from the cache if its files and the parser did not change since it was cached (nor, for an
+        ArrayExpress dataset without IDF file, its study metadata on the BioStudies API), and cached otherwise.
+        :param source: "geo" or "arrayexpress"
+        :param name: path to the SOFT file of a GEO dataset, or accession number of an ArrayExpress dataset
+        :param parser: SOFT parser to use, "stream" or "geoparse" (see read_softfile)
+        :return: dictionary with the transformed dataset
+        """
+        if source == "geo":
+            accession = basename(name).split("_")[0]
+            files = [name]
+            version = "geo " + parser + " " + str(SoftParser.PARSER_VERSION)
+        else:
+            accession = name
+            files = [self.file_path + accession + ".sdrf.txt", self.file_path + accession + ".idf.txt"]
+            version = "arrayexpress " + str(MageTabParser.PARSER_VERSION)
+            if not isfile(files[1]):
+                # without IDF file the study metadata comes from the BioStudies API, so its response is part of the key
+                study = self.cache.fetch("biostudies_study", self.study_url(accession))
+                version += " " + hashlib.sha256(study).hexdigest()
+        version += " " + str(TRANSFORM_VERSION)
+
+        if self.transform_cache is not None:
+            key = self.transform_cache.key(files, version)
+            dictionaryTemp = self.transform_cache.get(accession, key)
+            if dictionaryTemp is not None:
+                METRICS.increment("transform_cache_hits")
+                return dictionaryTemp
+            METRICS.increment("transform_cache_misses")
+
+        if source == "geo":
+            dictionaryTemp = self.geo_dictionary(name, parser)
+        else:
+            dictionaryTemp = self.arrayexpress_dictionary(accession)
+        if self.transform_cache is not None:
+            self.transform_cache.put(accession, key, files, dictionaryTemp)
+        return dictionaryTemp
+
+    def transformGEO(self, parser: str = "stream") -> None:
+        """
+        This method transforms the GEO's datasets extracted.
+        :param parser: SOFT parser to use, "stream" (default) or "geoparse" as a fallback
+        """
+        if self.transform_cache is not None:
+            self.transform_cache.evict_missing()
+        for file in self.softfiles():
+            if file.split("_")[0] in self.done:
+                continue
             filepath = self.file_path + file
-            gse = GEOparse.get_GEO(filepath=filepath)
-            dictionaryTemp = {
-                "database": "",
-                "title": "",
-                "data_type": "",
-                "organism": "",
-                "accession_number": "",
-                "platform_id": [],
-                "contributors": [],
-                "last_update_date": "",
-                "overall_design": "",
-                "samples": {}
-            }
-
-            # GSE (Series) is an original submitter-supplied record that summarizes the study, including samples and
-            # platforms
-            if "GSE" in gse.metadata["geo_accession"][0]:
-                dictionaryTemp["database"] = "GEO"
-
-            dictionaryTemp["title"] = gse.metadata["title"][0]
-            dictionaryTemp["data_type"] = " , ".join(gse.metadata["type"])
-
-            # GPL (Platform) contains a tab-delimited table containing the array definition
-            for gpl_name, gpl in gse.gpls.items():
-                dictionaryTemp["organism"] = gpl.metadata["organism"][0]
-
-            dictionaryTemp["accession_number"] = gse.metadata["geo_accession"][0]
-            dictionaryTemp["platform_id"] = gse.metadata["platform_id"]
-
-            if "contributor" in gse.metadata:
-                dictionaryTemp["contributors"] = gse.metadata["contributor"]
-
-            strDate = gse.metadata["last_update_date"][0]
-            dictionaryTemp["last_update_date"] = strDate
-
-            dictionaryTemp["overall_design"] = gse.metadata["overall_design"][0]
-
-            # GSM (Sample) contains information about the conditions and preparation of a sample
-            lista = []
-            for gsm_name, gsm in gse.gsms.items():
-                if "description" in gsm.metadata:
-                    lista.append(" ".join(gsm.metadata["description"]))
-                else:
-                    lista.append("")
-
-            dictionaryTemp["samples"] = {}
-            for i in range(len(gse.metadata["sample_id"])):
-                idt = gse.metadata["sample_id"][i]
-                for j in range(len(lista)):
-                    dictionaryTemp["samples"][idt] = lista[i]
+            self.add_dataset(self.transform_dataset("geo", filepath, parser))
 
-            x = "dataset" + str(self.index + 1)
-            self.dictionaryPrincipal[x] = dictionaryTemp.copy()
+    def check_soft_parity(self) -> list:
+        """
+        This method transforms every SOFT file of the staging area with both the streaming parser and GEOparse and
+        compares the results
+        :return: list with the names of the files whose transformed datasets differ
+        """
+        mismatches = []
+        for file in self.open_files(".soft.gz"):
+            filepath = self.file_path + file
+            if self.geo_dictionary(filepath, "stream") != self.geo_dictionary(filepath, "geoparse"):
+                mismatches.append(file)
+        return mismatches
 
-            self.index += 1
+    def study_url(self, accession: str) -> str:
+        """
+        :param accession: ArrayExpress accession number
+        :return: URL of the study metadata of the dataset on the BioStudies API
+        """
+        return self.urls["biostudies"] + "api/v1/studies/" + accession
 
-    def transformArrayExpress(self, organism, data_type_geo, data_type_ae):
+    def arrayexpress_dictionary(self, accession: str) -> dict:
         """
-        This method transforms the extracted ArrayExpress datasets.
+        This method transforms one extracted ArrayExpress dataset. The study metadata is read from the IDF file in the
+        staging area; if there is none, it is requested from the BioStudies API. The samples and platforms are read
+        from the SDRF file.
+        :param accession: ArrayExpress accession number of the dataset
+        :return: dictionary with the transformed dataset
         """
-        extract = Extract(organism, data_type_geo, data_type_ae)
-        accessions = extract.compare_accessions_array()
+        dictionaryTemp = {
+            "database": "",
+            "title": "",
+            "data_type": "",
+            "organism": "",
+            "accession_number": "",
+            "platform_id": [],
+            "contributors": [],
+            "last_update_date": "",
+            "overall_design": "",
+            "samples": {}
+        }
+        with METRICS.timer("parse_seconds", accession, source="ArrayExpress", parser="sdrf"):
+            sdrf = parse_sdrf(self.file_path + accession + ".sdrf.txt")
 
-        for accession in accessions:
-            dictionaryTemp = {
-                "database": "",
-                "title": "",
-                "data_type": "",
-                "organism": "",
-                "accession_number": "",
-                "platform_id": [],
-                "contributors": [],
-                "last_update_date": "",
-                "overall_design": "",
-                "samples": {}
-            }
-            api_url = "https://www.ebi.ac.uk/biostudies/api/v1/studies/" + accession
-            response = requests.get(api_url)
-            file = response.json()
+        idf_path = self.file_path + accession + ".idf.txt"
+        if isfile(idf_path):
+            idf = parse_idf(idf_path)
+            first_names = idf.get("personfirstname", [])
+            last_names = idf.get("personlastname", [])
+            for i in range(max(len(first_names), len(last_names))):
+                name = " ".join(n[i] for n in (first_names, last_names) if i < len(n) and n[i])
+                if name:
+                    dictionaryTemp["contributors"].append(name)
+
+            dictionaryTemp["accession_number"] = accession
+            dictionaryTemp["title"] = " ".join(idf.get("investigationtitle", []))
+            dictionaryTemp["database"] = "ArrayExpress"
+            dictionaryTemp["data_type"] = " , ".join(idf.get("comment[aeexperimenttype]", []))
+            dictionaryTemp["organism"] = ", ".join(sdrf["organisms"])
+            dictionaryTemp["overall_design"] = " ".join(idf.get("experimentdescription", []))
+        else:
+            file = self.cache.get_json("biostudies_study", self.study_url(accession))
 
             for i in file["section"]["subsections"]:
                 try:
@@ -149,45 +358,105 @@ class Transform:
             dictionaryTemp["data_type"] = file["section"]["attributes"][1]["value"]
             dictionaryTemp["organism"] = file["section"]["attributes"][2]["value"]
             dictionaryTemp["overall_design"] = file["section"]["attributes"][3]["value"]
-            dictionaryTemp["last_update_date"] = None
-
-            tempSourceName = None
-            tempDescription = None
-            tempPlatform = None
-            f = open(self.file_path + accession + ".sdrf.txt", "r")
-            for line in f.read().splitlines():
-                line = line.split("\t")
-                try:  # only runs the first line
-                    tempSourceName = line.index("Source Name")
-                    try:
-                        tempDescription = line.index("Description")
-                    except:
-                        tempDescription = None
-                    try:
-                        tempPlatform = line.index("Comment [Platform_title]")
-                    except:
-                        tempPlatform = None
-                except:
-                    samples_id = line[tempSourceName]
-                    dictionaryTemp["samples"][samples_id] = ""
-                    if tempDescription is not None:
-                        dictionaryTemp["samples"][samples_id] = line[tempDescription]
+        dictionaryTemp["last_update_date"] = None
 
-                    if tempPlatform is not None:
-                        dictionaryTemp["platform_id"].append(line[tempPlatform])
+        dictionaryTemp["samples"] = sdrf["samples"]
+        dictionaryTemp["platform_id"] = sdrf["platforms"]
 
-            x = "dataset" + str(self.index + 1)
-            self.dictionaryPrincipal[x] = dictionaryTemp.copy()
+        return dictionaryTemp
 
-            self.index += 1
+    def transformArrayExpress(self, organism, data_type_geo, data_type_ae):
+        """
+        This method transforms the extracted ArrayExpress datasets.
+        """
+        extract = Extract(organism, data_type_geo, data_type_ae, cache=self.cache, urls=self.urls)
+        accessions = extract.compare_accessions_array()
+
+        for accession in accessions:
+            if accession in self.done:
+                continue
+            self.add_dataset(self.transform_dataset("arrayexpress", accession))
+
+    def transformParallel(self, studies: list, workers: int = None, parser: str = "stream") -> dict:
+        """
+        This method transforms the GEO's datasets and then the ArrayExpress datasets of each study, like transformGEO
+        followed by transformArrayExpress, but spreads the files over a pool of processes. The results are merged in
+        the same order as a serial run, so the JSON file created is the same. A dataset that fails to be transformed
+        is left out and reported instead of stopping the others.
+        :param studies: list of (organism, data_type_geo, data_type_ae) tuples, in the order the ArrayExpress datasets
+        should be transformed
+        :param workers: number of processes of the pool (defaults to the number of CPUs)
+        :param parser: SOFT parser to use, "stream" (default) or "geoparse" (see read_softfile)
+        :return: dictionary where the keys are the files or accession numbers that failed and the values are the
+        error messages
+        """
+        jobs = [("geo", self.file_path + file) for file in self.softfiles()
+                if file.split("_")[0] not in self.done]
+        for organism, data_type_geo, data_type_ae in studies:
+            extract = Extract(organism, data_type_geo, data_type_ae, cache=self.cache, urls=self.urls)
+            jobs += [("arrayexpress", accession) for accession in extract.compare_accessions_array()
+                     if accession not in self.done]
+
+        if self.transform_cache is not None:
+            self.transform_cache.evict_missing()
+
+        failed = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map returns the results in the order of the jobs, whatever the order in which they finish
+            results = executor.map(transform_job, [(self.file_path, self.cache, self.transform_cache, self.urls, job,
+                                                    parser) for job in jobs])
+            for (source, name), (dictionaryTemp, error, metrics) in zip(jobs, results):
+                METRICS.merge(metrics)
+                if error is not None:
+                    print("FAILED TO TRANSFORM " + name + ": " + error)
+                    METRICS.increment("transform_failed", source=source)
+                    failed[name] = error
+                    continue
+                self.add_dataset(dictionaryTemp)
+        return failed
+
+
+def transform_job(args: tuple) -> tuple:
+    """
+    This function transforms one dataset in a worker process of Transform.transformParallel
+    :param args: tuple with the staging area folder, the response cache, the transform cache, the base URLs, the job
+    (source, file path or accession number) and the SOFT parser
+    :return: tuple with the transformed dataset and None, or None and the error message if the transform failed,
+    and the metrics recorded by the job (merged into the metrics of the main process)
+    """
+    file_path, cache, transform_cache, urls, (source, name), parser = args
+    transf = Transform(cache, transform_cache, urls)
+    transf.file_path = file_path
+    # the worker processes are reused, so the metrics of the previous job are cleared
+    METRICS.reset()
+    try:
+        result = transf.transform_dataset(source, name, parser), None
+    except Exception as error:
+        result = None, repr(error)
+    return result + (METRICS.snapshot(),)
 
 
 if __name__ == "__main__":
-    transf = Transform()
-    transf.transformGEO()
-    transf.transformArrayExpress("Vitis vinifera",
-                                 "Expression profiling by high throughput sequencing",
-                                 "RNA-seq of coding RNA")
-    transf.transformArrayExpress("Vitis vinifera", "Expression profiling by array",
-                                 "transcription profiling by array")
-    transf.createFile()
+    parser = argparse.ArgumentParser(description="Transform the datasets of the staging area into the newline-"
+                                                 "delimited JSON catalog (data/dataset.ndjson) read by "
+                                                 "Mongo_schema_Load and MongoCRUD")
+    parser.add_argument("--resume", action="store_true",
+                        help="keep the datasets already written by an interrupted run and transform only the others")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes transforming the datasets at the same time (see transformParallel)")
+    args = parser.parse_args()
+
+    db_file = "data/dataset.ndjson"
+    studies = [("Vitis vinifera", "Expression profiling by high throughput sequencing", "RNA-seq of coding RNA"),
+               ("Vitis vinifera", "Expression profiling by array", "transcription profiling by array")]
+    transf = Transform(transform_cache=TransformCache())
+    transf.open_catalog(db_file, resume=args.resume)
+    if args.workers > 1:
+        transf.transformParallel(studies, workers=args.workers)
+    else:
+        transf.transformGEO()
+        for organism, data_type_geo, data_type_ae in studies:
+            transf.transformArrayExpress(organism, data_type_geo, data_type_ae)
+    transf.close_catalog()
+    with open(db_file, encoding="utf-8") as catalog_file:
+        transf.createSQLiteCatalog(datasets=(json.loads(line) for line in catalog_file))
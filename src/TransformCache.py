@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from Manifest import file_checksum
+
+
+class TransformCache:
+    """
+    This class keeps the transformed dataset of each accession number in a SQLite file, so that the files of the staging
+    area that did not change since the last run are not parsed again. Each record is stored with a key made of the
+    checksums of the files it was transformed from and of the version of the parser, and is only used while both are
+    the same. The checksum of a file is only computed again when its size or modification time changes.
+    """
+
+    def __init__(self, path: str = "cache/transform.sqlite"):
+        """
+        :param path: path to the SQLite file of the cache
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # the SQLite connection is not sent to other processes, each one opens its own
+        state = self.__dict__.copy()
+        state["connection"] = None
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        :return: the connection to the SQLite file of the current process, created on first use
+        """
+        if self.connection is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS records (accession TEXT PRIMARY KEY, key TEXT, "
+                                    "files TEXT, record TEXT, stored REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS checksums (file TEXT PRIMARY KEY, size INTEGER, "
+                                    "mtime INTEGER, checksum TEXT)")
+            self.connection.commit()
+            self.pid = os.getpid()
+        return self.connection
+
+    def checksum(self, filepath: str) -> str:
+        """
+        :param filepath: path to a file of the staging area
+        :return: the SHA-256 checksum of the file, computed again only if the file changed size or modification time
+        """
+        stat = os.stat(filepath)
+        filepath = os.path.abspath(filepath)
+        with self.lock:
+            row = self.connect().execute("SELECT size, mtime, checksum FROM checksums WHERE file = ?",
+                                         (filepath,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        checksum = file_checksum(filepath)
+        with self.lock:
+            connection = self.connect()
+            connection.execute("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)",
+                               (filepath, stat.st_size, stat.st_mtime_ns, checksum))
+            connection.commit()
+        return checksum
+
+    def key(self, files: list, version: str) -> str:
+        """
+        :param files: paths to the files a dataset is transformed from (the ones that do not exist are left out)
+        :param version: version of the parser and transform
+        :return: key of the transformed dataset in the cache
+        """
+        checksums = [[os.path.basename(f), self.checksum(f)] for f in files if os.path.isfile(f)]
+        return hashlib.sha256(json.dumps([version, checksums]).encode("utf-8")).hexdigest()
+
+    def get(self, accession: str, key: str) -> dict:
+        """
+        :param accession: accession number of the dataset
+        :param key: key of the files and parser version (see key)
+        :return: the transformed dataset, or None if it is not in the cache or was transformed from other files or with
+        another parser version
+        """
+        with self.lock:
+            row = self.connect().execute("SELECT key, record FROM records WHERE accession = ?",
+                                         (accession,)).fetchone()
+        if row is None or row[0] != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[1])
+
+    def put(self, accession: str, key: str, files: list, record: dict) -> None:
+        """
+        This method stores a transformed dataset, replacing the previous one of the same accession number
+        :param accession: accession number of the dataset
+        :param key: key of the files and parser version (see key)
+        :param files: paths to the files the dataset was transformed from
+        :param record: the transformed dataset
+        """
+        with self.lock:
+            connection = self.connect()
+            connection.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)",
+                               (accession, key, json.dumps([os.path.abspath(f) for f in files if os.path.isfile(f)]),
+                                json.dumps(record, ensure_ascii=False), time.time()))
+            connection.commit()
+
+    def evict_missing(self) -> int:
+        """
+        This method deletes the datasets whose files are no longer in the staging area, and the checksums of those files
+        :return: number of datasets deleted
+        """
+        with self.lock:
+            connection = self.connect()
+            missing = [accession for accession, files in connection.execute("SELECT accession, files FROM records")
+                       if not all(os.path.isfile(f) for f in json.loads(files))]
+            connection.executemany("DELETE FROM records WHERE accession = ?", [(a,) for a in missing])
+            connection.executemany("DELETE FROM checksums WHERE file = ?",
+                                   [(f,) for f, in connection.execute("SELECT file FROM checksums")
+                                    if not os.path.isfile(f)])
+            connection.commit()
+        return len(missing)
+
+    def stats(self) -> dict:
+        """
+        :return: dictionary with the number of hits and misses of this cache object, and the number of cached datasets
+        """
+        with self.lock:
+            count = self.connect().execute("SELECT COUNT(*) FROM records").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "records": count}
@@ -1,130 +1,365 @@
+import cProfile
+import json
+import os
+import shutil
 import subprocess
+import time
+import tracemalloc
+from datetime import date, datetime
 import luigi
+from Catalog import Catalog
 from Extract import Extract
-import MongoCRUD
-import Mongo_schema_Load
+from Metrics import METRICS, Metrics
 from Transform import Transform
-
-
-# Task 1: Extract filtered data by RNA-Seq study and organism from the GEO database
-class ExtractDataGEORNASeq(luigi.Task):
-
-    def requires(self):
-        return None
+from TransformCache import TransformCache
+
+# GEO dataset type and ArrayExpress study type filters of each study
+STUDY_TYPES = {
+    "RNA-Seq": ("Expression profiling by high throughput sequencing", "RNA-seq of coding RNA"),
+    "Microarray": ("Expression profiling by array", "transcription profiling by array"),
+}
+
+
+# Extraction settings, read from the [extraction] section of the Luigi configuration
+class extraction(luigi.Config):
+    # extract only the metadata of the GEO datasets (brief SOFT files) instead of their family SOFT files
+    geo_metadata_only = luigi.BoolParameter(default=False)
+
+
+def study_extract(organism: str, study: str) -> Extract:
+    """
+    :param organism: organism in study
+    :param study: study name, a key of STUDY_TYPES
+    :return: Extract object with the filters of the organism and study
+    """
+    data_type, study_type = STUDY_TYPES[study]
+    return Extract(organism, data_type, study_type, geo_metadata_only=extraction().geo_metadata_only)
+
+
+# Metrics of the tasks: each task run records its metrics (see Metrics) in its own JSON file, since with several workers
+# the tasks run in separate processes, and the files are merged into the run report at the end of the workflow
+class metrics(luigi.Config):
+    path = luigi.Parameter(default="data/metrics/")
+    # optional profile of each task run: a cProfile file or the top memory allocations recorded by tracemalloc
+    profile = luigi.ChoiceParameter(choices=["", "cprofile", "tracemalloc"], default="")
+
+
+@luigi.Task.event_handler(luigi.Event.START)
+def start_task_metrics(task):
+    METRICS.reset()
+    task.metrics_start = time.perf_counter()
+    if metrics().profile == "cprofile":
+        task.profiler = cProfile.Profile()
+        task.profiler.enable()
+    elif metrics().profile == "tracemalloc":
+        tracemalloc.start()
+
+
+def save_task_metrics(task, status: str) -> None:
+    """
+    This function records the duration and status of a task run, saves the metrics recorded during the run and, if
+    enabled, its profile
+    :param task: Luigi task that finished
+    :param status: "success" or "failure"
+    """
+    config = metrics()
+    profiles = os.path.join(config.path, "profiles")
+    if config.profile == "cprofile" and hasattr(task, "profiler"):
+        task.profiler.disable()
+        os.makedirs(profiles, exist_ok=True)
+        task.profiler.dump_stats(os.path.join(profiles, task.task_id + ".prof"))
+    elif config.profile == "tracemalloc" and tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        os.makedirs(profiles, exist_ok=True)
+        with open(os.path.join(profiles, task.task_id + ".tracemalloc.txt"), "w", encoding="utf-8") as outfile:
+            outfile.write("peak: " + str(peak) + " bytes\n")
+            outfile.writelines(str(stat) + "\n" for stat in snapshot.statistics("lineno")[:25])
+
+    METRICS.increment("tasks", task=task.task_family, status=status)
+    if hasattr(task, "metrics_start"):
+        METRICS.observe("task_seconds", time.perf_counter() - task.metrics_start, task.task_id, task=task.task_family)
+    METRICS.save(os.path.join(config.path, "tasks", task.task_id + ".json"))
+
+
+@luigi.Task.event_handler(luigi.Event.SUCCESS)
+def task_success_metrics(task):
+    save_task_metrics(task, "success")
+
+
+@luigi.Task.event_handler(luigi.Event.FAILURE)
+def task_failure_metrics(task, exception):
+    save_task_metrics(task, "failure")
+
+
+def write_run_report(started: datetime, success: bool) -> dict:
+    """
+    This function merges the metrics of the tasks that ran into the run report (JSON) and the Prometheus textfile of
+    the run
+    :param started: date and time of the start of the run
+    :param success: True if the workflow succeeded
+    :return: the run report
+    """
+    path = metrics().path
+    run_metrics = Metrics()
+    tasks_path = os.path.join(path, "tasks")
+    if os.path.isdir(tasks_path):
+        for file in sorted(os.listdir(tasks_path)):
+            if file.endswith(".json"):
+                with open(os.path.join(tasks_path, file), encoding="utf-8") as infile:
+                    run_metrics.merge(json.load(infile))
+
+    report = {"started": started.isoformat(timespec="seconds"),
+              "finished": datetime.now().isoformat(timespec="seconds"),
+              "success": success}
+    report.update(run_metrics.snapshot())
+    with open(os.path.join(path, "run_report.json"), "w", encoding="utf-8") as outfile:
+        json.dump(report, outfile, indent=1)
+
+    # written under another name and renamed, so the node exporter never collects a partial file
+    prometheus = run_metrics.to_prometheus()
+    prometheus += "iplantsdb_omics_run_success " + str(int(success)) + "\n"
+    prometheus += "iplantsdb_omics_run_finished_timestamp_seconds " + str(int(time.time())) + "\n"
+    with open(os.path.join(path, "iplantsdb_omics.prom.part"), "w", encoding="utf-8") as outfile:
+        outfile.write(prometheus)
+    os.replace(os.path.join(path, "iplantsdb_omics.prom.part"), os.path.join(path, "iplantsdb_omics.prom"))
+    return report
+
+
+# The outputs of the tasks are kept per run date, so that the databases are searched again and the datasets extracted
+# again if updated (see Extract.update_file) on each daily run; the unchanged files are neither downloaded nor parsed
+# again (see TransformCache)
+
+# Only one task at a time sends requests to the external sources (Luigi resource, 1 unless set in the [resources]
+# section of the Luigi configuration), so that the rate limit of the downloader (see Extract.download_updated) holds
+# for the whole workflow and not only for each task
+EXTERNAL_SOURCES = {"external_sources": 1}
+
+
+# Task 1: Search GEO and the ArrayExpress collection on BioStudies for the datasets of an organism and study
+class DiscoverAccessions(luigi.Task):
+    organism = luigi.Parameter()
+    study = luigi.ChoiceParameter(choices=list(STUDY_TYPES))
+    run_date = luigi.DateParameter(default=date.today())
+    resources = EXTERNAL_SOURCES
 
     def output(self):
-        return luigi.LocalTarget("data/ExtractGEORNASeq.txt")
+        discovery_file = study_extract(self.organism, self.study).discovery_file()
+        return luigi.LocalTarget("data/discovery/" + str(self.run_date) + "/" + os.path.basename(discovery_file))
 
     def run(self):
-        extract = Extract("Vitis vinifera", "Expression profiling by high throughput sequencing",
-                          "RNA-seq of coding RNA")
-        extract.download_softfiles()
-
+        discovery = study_extract(self.organism, self.study).discover(refresh=True)
         with self.output().open("w") as outfile:
-            outfile.write("RNA-Seq study type datasets were extracted from GEO")
+            json.dump(discovery, outfile, indent=1)
 
 
-# Task 2: Extract filtered data by microarray study and organism from the GEO database
-class ExtractDataGEOMicroArray(luigi.Task):
+# Task 2: Extract the new and updated files of the datasets of an organism and study (SOFT files from GEO, SDRF and IDF
+# files from ArrayExpress) to the staging area, several at a time with one downloader
+class ExtractStudy(luigi.Task):
+    organism = luigi.Parameter()
+    study = luigi.ChoiceParameter(choices=list(STUDY_TYPES))
+    run_date = luigi.DateParameter(default=date.today())
+    resources = EXTERNAL_SOURCES
 
     def requires(self):
-        return None
+        return DiscoverAccessions(organism=self.organism, study=self.study, run_date=self.run_date)
 
     def output(self):
-        return luigi.LocalTarget("data/ExtractGEOMicroArray.txt")
+        return luigi.LocalTarget("data/extract/" + str(self.run_date) + "/" + self.organism.replace(" ", "_") + "_" +
+                                 self.study + ".txt")
 
     def run(self):
-        extract = Extract("Vitis vinifera", "Expression profiling by array",
-                          "transcription profiling by array")
-        extract.download_softfiles()
+        with self.input().open("r") as discovery_file:
+            discovery = json.load(discovery_file)
+        extract = study_extract(self.organism, self.study)
+        extract.download_updated("GEO", [(accession,) + extract.dataset_file("GEO", accession)
+                                         for accession in discovery["geo"]])
+        arrayexpress = []
+        for accession in discovery["arrayexpress"]:
+            arrayexpress.append((accession,) + extract.dataset_file("ArrayExpress", accession))
+            arrayexpress.append((accession + ".idf",) + extract.idf_file(accession))
+        extract.download_updated("ArrayExpress", arrayexpress)
 
         with self.output().open("w") as outfile:
-            outfile.write("Microarray study type datasets were extracted from GEO")
+            outfile.write(self.study + " study type datasets of " + self.organism + " were extracted")
 
 
-# Task 3: Extract filtered data by RNA-Seq study and organism from the ArrayExpress collection on BioStudies database
-class ExtractDataArrayExpressRNASeq(luigi.Task):
-
-    def requires(self):
-        return ExtractDataGEORNASeq()
+# Task 3: Delete from the transform cache the datasets whose files are no longer in the staging area, once per run
+class EvictTransformCache(luigi.Task):
+    run_date = luigi.DateParameter(default=date.today())
 
     def output(self):
-        return luigi.LocalTarget("data/ExtractRNASeq.txt")
+        return luigi.LocalTarget("data/transform/" + str(self.run_date) + "/evicted.txt")
 
     def run(self):
-        extract = Extract("Vitis vinifera", "Expression profiling by high throughput sequencing",
-                          "RNA-seq of coding RNA")
-        extract.download_sdrf()
-
+        evicted = TransformCache().evict_missing()
         with self.output().open("w") as outfile:
-            outfile.write("RNA-Seq study type datasets were extracted from ArrayExpress")
+            outfile.write(str(evicted) + " datasets without files in the staging area were deleted from the transform "
+                                         "cache")
 
 
-# Task 4: Extract filtered data by microarray study and organism from the ArrayExpress collection on BioStudies database
-class ExtractDataArrayExpressMicroArray(luigi.Task):
-
-    def requires(self):
-        return ExtractDataGEOMicroArray()
+# Task 4: Transform the extracted file of one dataset
+class TransformAccession(luigi.Task):
+    source = luigi.ChoiceParameter(choices=["GEO", "ArrayExpress"])
+    accession = luigi.Parameter()
+    run_date = luigi.DateParameter(default=date.today())
+    # the same dataset can be found for several organisms and studies, but it is only transformed once
+    organism = luigi.Parameter(significant=False)
+    study = luigi.Parameter(significant=False)
 
     def output(self):
-        return luigi.LocalTarget("data/ExtractMicroArray.txt")
+        return luigi.LocalTarget("data/transform/" + str(self.run_date) + "/" + self.accession + ".json")
 
     def run(self):
-        extract = Extract("Vitis vinifera", "Expression profiling by array",
-                          "transcription profiling by array")
-        extract.download_sdrf()
+        # the files that did not change since they were last transformed are not parsed again
+        transf = Transform(transform_cache=TransformCache())
+        if self.source == "GEO":
+            url, filepath = study_extract(self.organism, self.study).dataset_file(self.source, self.accession)
+            dataset = transf.transform_dataset("geo", filepath)
+        else:
+            dataset = transf.transform_dataset("arrayexpress", self.accession)
 
         with self.output().open("w") as outfile:
-            outfile.write("Microarray study type datasets were extracted from ArrayExpress")
+            json.dump(dataset, outfile, ensure_ascii=False)
 
 
-# Task 5: Transform data retrieved from the previously tasks
-class TransformData(luigi.Task):
+# Task 5: Transform all the extracted datasets of an organism and study, one task per dataset
+class TransformStudy(luigi.Task):
+    organism = luigi.Parameter()
+    study = luigi.ChoiceParameter(choices=list(STUDY_TYPES))
+    run_date = luigi.DateParameter(default=date.today())
 
     def requires(self):
-        return ExtractDataArrayExpressRNASeq(), ExtractDataArrayExpressMicroArray()
+        # the cache is cleaned before the tasks of the datasets read it
+        return [ExtractStudy(organism=self.organism, study=self.study, run_date=self.run_date),
+                EvictTransformCache(run_date=self.run_date)]
 
     def output(self):
-        return luigi.LocalTarget("data/dataset.json")  # "data/Transform.txt"
+        return luigi.LocalTarget("data/" + self.organism.replace(" ", "_") + "_" + self.study + "_" +
+                                 str(self.run_date) + ".txt")
+
+    def accession_tasks(self) -> list:
+        """
+        :return: list with the TransformAccession tasks of the datasets found for the organism and study, GEO's first
+        """
+        discovery_task = DiscoverAccessions(organism=self.organism, study=self.study, run_date=self.run_date)
+        with discovery_task.output().open("r") as discovery_file:
+            discovery = json.load(discovery_file)
+        return ([TransformAccession(source="GEO", accession=accession, run_date=self.run_date,
+                                    organism=self.organism, study=self.study)
+                 for accession in discovery["geo"]] +
+                [TransformAccession(source="ArrayExpress", accession=accession, run_date=self.run_date,
+                                    organism=self.organism, study=self.study)
+                 for accession in discovery["arrayexpress"]])
 
     def run(self):
-        transf = Transform()
-        transf.transformGEO()
-        transf.transformArrayExpress("Vitis vinifera",
-                                     "Expression profiling by high throughput sequencing",
-                                     "RNA-seq of coding RNA")
-        transf.transformArrayExpress("Vitis vinifera", "Expression profiling by array",
-                                     "transcription profiling by array")
+        # dynamic dependencies: Luigi runs the tasks of the datasets (in parallel when there are several workers)
+        # and only reruns the ones that failed
+        yield self.accession_tasks()
 
-        transf.createFile()
+        with self.output().open("w") as outfile:
+            outfile.write(self.study + " study type datasets of " + self.organism + " were extracted and transformed")
+
+
+def transformed_datasets(study_tasks: list):
+    """
+    :param study_tasks: TransformStudy tasks that ran
+    :return: generator of the datasets transformed by the tasks, each dataset once, in the order of the studies
+    """
+    done = set()
+    for study_task in study_tasks:
+        for task in study_task.accession_tasks():
+            if task.accession in done:
+                continue
+            done.add(task.accession)
+            with task.output().open("r") as infile:
+                yield json.load(infile)
 
 
 # Task 6: Perform the load and update of the target database on Mongodb
 class SaveAndUpdateData(luigi.Task):
+    organisms = luigi.ListParameter(default=("Vitis vinifera",))
+    studies = luigi.ListParameter(default=tuple(STUDY_TYPES))
+    run_date = luigi.DateParameter(default=date.today())
+    # store the samples in their own collection instead of embedding them in the datasets
+    separate_samples = luigi.BoolParameter(default=False)
 
     def requires(self):
-        return TransformData()
+        return [TransformStudy(organism=organism, study=study, run_date=self.run_date)
+                for organism in self.organisms for study in self.studies]
 
     def output(self):
-        return luigi.LocalTarget("data/Load.txt")
+        return luigi.LocalTarget("data/Load_" + str(self.run_date) + ".txt")
 
     def run(self):
-        db_file = "data/dataset.json"
-        transcript_data = Mongo_schema_Load.read_json_database(filename=db_file)
-        MongoCRUD.update_mongo(transcript_data)
+        # the transformed datasets are gathered into the catalog, each dataset once, in the order of the studies
+        db_file = "data/dataset.ndjson"
+        with open(db_file, "w", encoding="utf-8") as catalog:
+            for dataset in transformed_datasets(self.requires()):
+                catalog.write(json.dumps(dataset, ensure_ascii=False) + "\n")
+
+        # MongoEngine is only imported (and the target database connected) by the task that loads the data
+        import MongoCRUD
+        import Mongo_schema_Load
+        transcript_data = Mongo_schema_Load.read_ndjson_database(filename=db_file)
+        MongoCRUD.update_mongo(transcript_data, separate_samples=self.separate_samples)
         with self.output().open("w") as outfile:
             outfile.write("data loaded into target database on Mongodb")
 
 
-def execute_pipeline():
-    p = subprocess.Popen('luigid', stdout=subprocess.PIPE, shell=False)
-    res = luigi.build([SaveAndUpdateData()])
-    p.kill()
+# Task 7: Export the transformed datasets to the local SQLite catalog, for searches without the target database
+class ExportCatalog(luigi.Task):
+    organisms = luigi.ListParameter(default=("Vitis vinifera",))
+    studies = luigi.ListParameter(default=tuple(STUDY_TYPES))
+    run_date = luigi.DateParameter(default=date.today())
+
+    def requires(self):
+        return [TransformStudy(organism=organism, study=study, run_date=self.run_date)
+                for organism in self.organisms for study in self.studies]
+
+    def output(self):
+        return luigi.LocalTarget("data/Catalog_" + str(self.run_date) + ".txt")
+
+    def run(self):
+        catalog = Catalog()
+        counts = catalog.upsert(transformed_datasets(self.requires()))
+        catalog.close()
+        with self.output().open("w") as outfile:
+            outfile.write("datasets exported to " + catalog.path + ": " + json.dumps(counts))
+
+
+def build_pipeline(workers: int = 4, local_scheduler: bool = False, run_date: date = None) -> bool:
+    """
+    This function runs the workflow and writes its run report (see write_run_report)
+    :param workers: number of Luigi workers
+    :param local_scheduler: if True, schedule the tasks in this process instead of the central scheduler (luigid)
+    :param run_date: date of the run, whose tasks are run once (defaults to today)
+    :return: True if the workflow succeeded
+    """
+    run_date = run_date or date.today()
+    started = datetime.now()
+    # the metrics of the previous run are cleared, the report only covers the tasks of this run
+    shutil.rmtree(os.path.join(metrics().path, "tasks"), ignore_errors=True)
+    shutil.rmtree(os.path.join(metrics().path, "profiles"), ignore_errors=True)
+    os.makedirs(metrics().path, exist_ok=True)
+    res = luigi.build([SaveAndUpdateData(run_date=run_date), ExportCatalog(run_date=run_date)], workers=workers,
+                      local_scheduler=local_scheduler)
+    write_run_report(started, res)
+    return res
+
+
+def execute_pipeline(workers: int = 4, local_scheduler: bool = False):
+    # short runs can use the local scheduler and skip starting luigid
+    if local_scheduler:
+        res = build_pipeline(workers, local_scheduler=True)
+    else:
+        p = subprocess.Popen('luigid', stdout=subprocess.PIPE, shell=False)
+        res = build_pipeline(workers)
+        p.kill()
     if not res:
-        raise 'An error has occorred during luigi workflow'
+        raise Exception('An error has occorred during luigi workflow')
 
 
 if __name__ == "__main__":
-    # luigi.build([ExtractData()])
-    # luigi.build([TransformData()])
-    luigi.build([SaveAndUpdateData()])
+    build_pipeline(workers=4)
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+# The modules of the pipeline import each other from the src folder
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
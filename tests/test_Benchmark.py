@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+import mongoengine
+
+from Benchmark import Benchmark, write_synthetic_staging
+from Mongo_schema_Load import Transcriptomics
+
+
+def test_run_loads_into_mongomock(tmp_path):
+    staging = str(tmp_path) + "/"
+    write_synthetic_staging(staging, 5, samples=3, platform_rows=10, sample_rows=10)
+    try:
+        results = Benchmark(staging).run("mongomock")
+        assert results["stages"]["load"]["items"] == 5
+        assert Transcriptomics.objects.count() == 5
+
+        # a second run starts again from an empty collection
+        Benchmark(staging).run("mongomock")
+        assert Transcriptomics.objects.count() == 5
+    finally:
+        Transcriptomics.drop_collection()
+        mongoengine.disconnect()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import copy
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+import mongoengine
+
+import Mongo_schema_Load
+from Mongo_schema_Load import Transcriptomics, TranscriptomicsSample, bulk_upsert
+
+
+def dataset(accession: str, samples: int = 3) -> dict:
+    """
+    :param accession: accession number of the dataset
+    :param samples: number of samples of the dataset
+    :return: transformed dataset, with the fields of the JSON file created by Transform
+    """
+    return {
+        "database": "GEO",
+        "title": "Series " + accession,
+        "data_type": "Expression profiling by array",
+        "organism": "Vitis vinifera",
+        "accession_number": accession,
+        "platform_id": ["GPL1"],
+        "contributors": ["A Author"],
+        "last_update_date": "2024-01-01",
+        "overall_design": "Design of " + accession,
+        "samples": {accession + "_S" + str(i): "sample " + str(i) for i in range(samples)}
+    }
+
+
+@pytest.fixture(autouse=True)
+def mongo():
+    mongoengine.disconnect()
+    mongoengine.connect("test", mongo_client_class=mongomock.MongoClient)
+    yield
+    Transcriptomics.drop_collection()
+    TranscriptomicsSample.drop_collection()
+    mongoengine.disconnect()
+
+
+def test_bulk_upsert_counts():
+    datasets = [dataset("GSE" + str(n)) for n in range(5)]
+    assert bulk_upsert(datasets, batch_size=2) == {"inserted": 5, "updated": 0, "unchanged": 0}
+    assert bulk_upsert(datasets, batch_size=2) == {"inserted": 0, "updated": 0, "unchanged": 5}
+
+    changed = copy.deepcopy(datasets)
+    changed[1]["title"] = "New title"
+    changed.append(dataset("GSE9"))
+    assert bulk_upsert(changed, batch_size=2) == {"inserted": 1, "updated": 1, "unchanged": 4}
+    assert Transcriptomics.objects.count() == 6
+    assert Transcriptomics.objects.get(accession_number="GSE1").title == "New title"
+
+
+def test_bulk_upsert_separate_samples():
+    datasets = [dataset("GSE1", samples=4), dataset("GSE2", samples=2)]
+    assert bulk_upsert(datasets, separate_samples=True) == {"inserted": 2, "updated": 0, "unchanged": 0}
+
+    doc = Transcriptomics._get_collection().find_one({"_id": "GSE1"})
+    assert doc.get("samples", {}) == {}
+    assert doc["sample_count"] == 4
+    assert doc["sample_ids"] == list(datasets[0]["samples"])
+    samples = TranscriptomicsSample._get_collection()
+    assert samples.count_documents({}) == 6
+    assert samples.find_one({"dataset": "GSE2", "sample_id": "GSE2_S1"})["description"] == "sample 1"
+
+    # the same datasets in the same layout are unchanged; in the other layout they are replaced and their samples
+    # embedded again
+    assert bulk_upsert(datasets, separate_samples=True)["unchanged"] == 2
+    assert bulk_upsert(datasets) == {"inserted": 0, "updated": 2, "unchanged": 0}
+    assert samples.count_documents({}) == 0
+    assert Transcriptomics._get_collection().find_one({"_id": "GSE2"})["samples"] == datasets[1]["samples"]
+
+
+def test_replace_documents_uses_bulk_write_on_pymongo():
+    calls = []
+
+    class Result:
+        upserted_count = 1
+
+    class Collection:
+        def bulk_write(self, operations, ordered):
+            calls.append((operations, ordered))
+            return Result()
+
+    assert Mongo_schema_Load.replace_documents(Collection(), [{"_id": "GSE1"}, {"_id": "GSE2"}]) == 1
+    assert len(calls) == 1 and len(calls[0][0]) == 2 and calls[0][1] is False